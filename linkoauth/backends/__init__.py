@@ -21,20 +21,30 @@
 # Contributor(s):
 #
 import abc
+import time
+import Queue
+import logging
+import threading
+from collections import OrderedDict
 
 from webob.exc import HTTPRedirection
 from services.pluginreg import PluginRegistry
 
 from linkoauth.backends import facebook_, google_, twitter_, yahoo_, linkedin_
-from linkoauth.sstatus import ServicesStatus
+from linkoauth.sstatus import ServicesStatus, BACKGROUND_POOL_SIZE
 from linkoauth.errors import BackendError, DomainNotRegisteredError
-from linkoauth.errors import OAuthKeysException
+from linkoauth.errors import OAuthKeysException, DeadlineExceededError
+from linkoauth.errors import StatusReadError, StatusWriteError
+from linkoauth.util import get_config_index, deadline, current_deadline
+from linkoauth.workers import WorkerPool, Bulkhead
 
 #from linkoauth.live_ import LiveResponder
 #from linkoauth.openidconsumer import OpenIDResponder
 
 __all__ = ['Responder', 'get_responder', 'Requester', 'get_requester',
-           'Services']
+           'RequesterCache', 'Services']
+
+log = logging.getLogger(__name__)
 
 
 class Responder(PluginRegistry):
@@ -127,11 +137,81 @@ def get_requester(domain, account, **kw):
             raise
 
 
+class RequesterCache(object):
+    """Bounded LRU cache of requesters, keyed by domain and account tokens.
+
+    Building a requester loads the OAuth configuration and creates the
+    oauth consumer and token objects, so the requesters of the `size` most
+    recent accounts are kept and reused for `ttl` seconds, or until the
+    configuration changes.
+    """
+    def __init__(self, size=1000, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self._requesters = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, domain, account):
+        return (domain, account.get('oauth_token'),
+                account.get('oauth_token_secret'))
+
+    def get(self, domain, account):
+        if not isinstance(account, dict):
+            # nothing to key on, get_requester will complain
+            return get_requester(domain, account)
+
+        key = self._key(domain, account)
+        now = time.time()
+        index = get_config_index()
+        with self._lock:
+            entry = self._requesters.pop(key, None)
+            if entry is not None and entry[0] > now and entry[1] is index:
+                # most recently used goes last
+                self._requesters[key] = entry
+                requester = entry[2]
+                # the profile may have changed, not the tokens
+                requester.account = account
+                return requester
+
+        requester = get_requester(domain, account)
+        with self._lock:
+            self._requesters[key] = now + self.ttl, index, requester
+            while len(self._requesters) > self.size:
+                self._requesters.popitem(last=False)
+        return requester
+
+    def invalidate(self, domain, account=None):
+        """Drops the requester of an account, or all the requesters of the
+        domain when no account is given."""
+        with self._lock:
+            if account is not None:
+                self._requesters.pop(self._key(domain, account), None)
+                return
+            for key in self._requesters.keys():
+                if key[0] == domain:
+                    del self._requesters[key]
+
+    def clear(self):
+        with self._lock:
+            self._requesters.clear()
+
+    def __len__(self):
+        return len(self._requesters)
+
+
 # high-level
 class Services(ServicesStatus):
 
     def __init__(self, services, servers=None, ttl=600,
-                 feedback_enabled=True):
+                 feedback_enabled=True, flush_interval=None,
+                 flush_events=100, bucket_size=None, buckets=60,
+                 packed=False, pool_size=None, mmap_path=None,
+                 queue_size=None, requester_cache_size=1000,
+                 requester_cache_ttl=300, send_pool_size=10,
+                 async_pool_size=50,
+                 bulkhead_size=None, bulkhead_sizes=None,
+                 bulkhead_timeout=.5, timeout=None, history_size=None,
+                 history_interval=60.):
         requesters = [req.get_name() for req in Requester._abc_registry]
         responders = [res.get_name() for res in Responder._abc_registry]
 
@@ -143,41 +223,287 @@ class Services(ServicesStatus):
                 raise DomainNotRegisteredError(service)
 
         self.feedback_enabled = feedback_enabled
-        ServicesStatus.__init__(self, services, servers, ttl)
+        # default time budget of the calls, see _deadline
+        self.timeout = timeout
+        # the responders hold no per-request state, one per domain is
+        # enough and keeps their OpenID stores alive
+        self._responders = {}
+        self._responders_lock = threading.Lock()
+        if requester_cache_size:
+            self.requesters = RequesterCache(requester_cache_size,
+                                             requester_cache_ttl)
+        else:
+            self.requesters = None
+        # threads running the concurrent sends, see sendmessage_many, and
+        # the async calls, see sendmessage_async
+        self.send_pool_size = send_pool_size
+        self.async_pool_size = async_pool_size
+        self._pools = {}
+        self._pools_lock = threading.Lock()
+        # caps the concurrent calls per domain, so a slow provider cannot
+        # hold all the threads. bulkhead_sizes overrides bulkhead_size for
+        # some domains.
+        self.bulkhead_timeout = bulkhead_timeout
+        self.bulkheads = {}
+        for service in services:
+            size = (bulkhead_sizes or {}).get(service, bulkhead_size)
+            if size:
+                self.bulkheads[service] = Bulkhead(size)
+        if pool_size is None:
+            # the send and async threads update the statuses too
+            pool_size = BACKGROUND_POOL_SIZE
+        ServicesStatus.__init__(self, services, servers, ttl, flush_interval,
+                                flush_events, bucket_size, buckets, packed,
+                                pool_size=pool_size, mmap_path=mmap_path,
+                                queue_size=queue_size,
+                                history_size=history_size,
+                                history_interval=history_interval)
+
+    def _deadline(self, timeout=None, when=None):
+        """Returns the deadline of a call given its `timeout` (seconds) or
+        `deadline` (a time.time() value) options. The default timeout
+        applies too, the earliest deadline wins."""
+        if timeout is None:
+            timeout = self.timeout
+        if timeout is not None:
+            expires = time.time() + timeout
+            if when is None or expires < when:
+                when = expires
+        return when
+
+    def _bulkhead_wait(self):
+        wait = self.bulkhead_timeout
+        when = current_deadline()
+        if when is not None:
+            left = max(when - time.time(), 0)
+            if wait is None or left < wait:
+                wait = left
+        return wait
+
+    def _feedback(self, domain, success, latency=None):
+        # the provider result matters more than the status of the cache
+        if not self.feedback_enabled:
+            return
+        try:
+            self.update_status(domain, success, latency)
+        except (StatusReadError, StatusWriteError):
+            log.warn('could not update the status of %s' % domain)
 
     def _updated(func):
         def __updated(self, domain, *args, **kw):
             domain = str(domain)
-            try:
-                res = func(self, domain, *args, **kw)
-            except BackendError, e:
-                if self.feedback_enabled:
-                    self.update_status(domain, False)
-                return None, e.args[0]
-            except HTTPRedirection:
-                if self.feedback_enabled:
-                    self.update_status(domain, True)
-                raise
-            else:
-                if (len(res) == 2 and res[0] is not None and
-                    self.feedback_enabled):
-                    self.update_status(domain, True)
-            return res
+            when = self._deadline(kw.pop('timeout', None),
+                                  kw.pop('deadline', None))
+            with deadline(when):
+                bulkhead = self.bulkheads.get(domain)
+                if (bulkhead is not None and
+                    not bulkhead.acquire(self._bulkhead_wait())):
+                    log.warn('too many concurrent calls to %s' % domain)
+                    self._feedback(domain, False)
+                    return None, {'provider': domain, 'code': 503,
+                                  'message': 'too many concurrent requests'}
+                start = time.time()
+                try:
+                    res = func(self, domain, *args, **kw)
+                except BackendError, e:
+                    self._feedback(domain, False, time.time() - start)
+                    return None, e.args[0]
+                except DeadlineExceededError, e:
+                    log.warn('%s: %s' % (domain, e))
+                    self._feedback(domain, False, time.time() - start)
+                    return None, {'provider': domain, 'code': 504,
+                                  'message': str(e)}
+                except HTTPRedirection:
+                    self._feedback(domain, True, time.time() - start)
+                    raise
+                else:
+                    if len(res) == 2 and res[0] is not None:
+                        self._feedback(domain, True, time.time() - start)
+                finally:
+                    if bulkhead is not None:
+                        bulkhead.release()
+                return res
         return __updated
 
+    def _get_requester(self, domain, account, **kw):
+        if self.requesters is None or kw:
+            return get_requester(domain, account, **kw)
+        return self.requesters.get(domain, account)
+
+    def invalidate_requester(self, domain, account=None):
+        """Drops the cached requester of an account, or of all the accounts
+        of the domain. To be called when the tokens of an account are
+        revoked or the OAuth configuration changes."""
+        if self.requesters is not None:
+            self.requesters.invalidate(domain, account)
+
     @_updated
     def sendmessage(self, domain, account, *args, **kw):
-        return get_requester(domain, account).sendmessage(*args, **kw)
+        return self._get_requester(domain, account).sendmessage(*args, **kw)
 
     @_updated
     def getcontacts(self, domain, account, page_data, headers, **kw):
-        return get_requester(domain, account, **kw).getcontacts(page_data,
-                                                                headers)
+        return self._get_requester(domain, account, **kw).getcontacts(
+                page_data, headers)
+
+    def _get_responder(self, domain, **kw):
+        if kw:
+            return get_responder(domain, **kw)
+        index = get_config_index()
+        with self._responders_lock:
+            entry = self._responders.get(domain)
+            # a new configuration gets new responders
+            if entry is None or entry[0] is not index:
+                entry = index, get_responder(domain)
+                self._responders[domain] = entry
+            return entry[1]
+
+    def _get_pool(self, name, size):
+        with self._pools_lock:
+            pool = self._pools.get(name)
+            if pool is None:
+                pool = self._pools[name] = WorkerPool(size,
+                                                      'services-%s' % name)
+            return pool
+
+    def _get_send_pool(self):
+        return self._get_pool('send', self.send_pool_size)
+
+    def _get_async_pool(self):
+        # apart from the send pool, so a large batch does not hold back
+        # the async calls
+        return self._get_pool('async', self.async_pool_size)
+
+    def _safe_sendmessage(self, domain, account, message, options, headers,
+                          when=None):
+        # the errors of a concurrent send end up in its result
+        try:
+            with deadline(when):
+                return self.sendmessage(domain, account, message, options,
+                                        headers)
+        except Exception, e:
+            log.exception('could not send a message with %s' % domain)
+            return None, {'provider': domain, 'message': str(e)}
+
+    def sendmessage_many(self, domain, items, headers=None, timeout=None):
+        """Sends several messages with a domain concurrently.
+
+        items is a list of (account, message, options). The messages are
+        sent by a pool of send_pool_size threads and the result is the list
+        of the (result, error) of each item, in the same order, as returned
+        by sendmessage. The status of the domain is updated for each item.
+
+        When given, `timeout` is the time in seconds to wait for all the
+        items. The items that are not done in time get a 504 error: the
+        ones that did not start are not sent, the others are aborted.
+        """
+        when = self._deadline(timeout)
+        pool = self._get_send_pool()
+        # the requesters write in the headers, each item gets its own
+        tasks = [pool.submit(self._safe_sendmessage,
+                             (domain, account, message, options,
+                              headers and dict(headers), when))
+                 for account, message, options in items]
+
+        results = []
+        for task in tasks:
+            if when is None:
+                task.wait()
+            elif not task.wait(max(when - time.time(), 0)):
+                task.cancel()
+                results.append((None, {'provider': domain, 'code': 504,
+                                       'message': 'timed out'}))
+                continue
+            results.append(task.get())
+        return results
+
+    def sendmessage_async(self, domain, account, message, options,
+                          headers=None, timeout=None):
+        """Non-blocking sendmessage: returns right away a Task (see
+        linkoauth.workers). Its get() returns the (result, error) of
+        sendmessage, or raises its exception.
+
+        The calls run in a pool of async_pool_size threads: at most that
+        many are in flight at once, the others wait for a thread. The time
+        spent waiting counts in `timeout`."""
+        return self._get_async_pool().submit(self.sendmessage,
+                                             (domain, account, message,
+                                              options, headers),
+                                             {'deadline':
+                                              self._deadline(timeout)})
+
+    def getcontacts_async(self, domain, account, page_data, headers, **kw):
+        """Non-blocking getcontacts, see sendmessage_async."""
+        kw['deadline'] = self._deadline(kw.pop('timeout', None),
+                                        kw.pop('deadline', None))
+        return self._get_async_pool().submit(self.getcontacts,
+                                             (domain, account, page_data,
+                                              headers), kw)
+
+    def iter_share(self, targets, timeout=None, headers=None):
+        """Shares with several domains concurrently and yields the
+        (domain, (result, error)) as they complete.
+
+        targets is a list of (domain, account, message, options), one per
+        domain. When given, `timeout` is a deadline in seconds shared by
+        all the domains: the ones that are not done in time are aborted and
+        yielded last with a 504 error. The status of each domain is updated
+        as with sendmessage.
+        """
+        domains = [target[0] for target in targets]
+        if len(set(domains)) != len(domains):
+            raise ValueError('one target per domain')
+
+        when = self._deadline(timeout)
+        pool = self._get_send_pool()
+        done = Queue.Queue()
+        tasks = {}
+        for domain, account, message, options in targets:
+            # the requesters write in the headers, see sendmessage_many
+            task = pool.submit(self._safe_sendmessage,
+                               (domain, account, message, options,
+                                headers and dict(headers), when),
+                               done=done)
+            tasks[task] = domain
+
+        while tasks:
+            try:
+                if when is None:
+                    task = done.get()
+                else:
+                    task = done.get(timeout=max(when - time.time(), 0))
+            except Queue.Empty:
+                break
+            yield tasks.pop(task), task.get()
+
+        # out of time
+        for task, domain in tasks.items():
+            task.cancel()
+            yield domain, (None, {'provider': domain, 'code': 504,
+                                  'message': 'timed out'})
+
+    def share(self, targets, timeout=None, headers=None):
+        """Shares with several domains concurrently, see iter_share.
+
+        Returns a mapping of domain -> (result, error).
+        """
+        return dict(self.iter_share(targets, timeout, headers))
+
+    def close(self):
+        with self._pools_lock:
+            pools, self._pools = self._pools.values(), {}
+        for pool in pools:
+            pool.stop()
+        ServicesStatus.close(self)
 
     def request_access(self, domain, request, url, session, **kw):
-        return get_responder(domain, **kw).request_access(request, url,
-                                                          session)
+        with deadline(self._deadline(kw.pop('timeout', None),
+                                     kw.pop('deadline', None))):
+            return self._get_responder(domain, **kw).request_access(
+                    request, url, session)
 
     def verify(self, domain, request, url, session, **kw):
-        return get_responder(domain, **kw).verify(request, url,
-                                                  session)
+        with deadline(self._deadline(kw.pop('timeout', None),
+                                     kw.pop('deadline', None))):
+            return self._get_responder(domain, **kw).verify(request, url,
+                                                            session)
@@ -300,6 +300,12 @@ class FacebookRequester(object):
 
         return self.rawcall(url, body, "POST", headers=headers)
 
+    def probe(self, headers=None):
+        # cheap authenticated call for the health prober
+        url = config.get("oauth.facebook.com.profile",
+                         FacebookResponder.profile_url)
+        return self.rawcall(url, params={'fields': 'id'}, headers=headers)
+
     def getcontacts(self, options, headers):
         offset = int(options.get('offset', 0))
         limit = int(options.get('limit', 25))
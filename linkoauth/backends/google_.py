@@ -54,7 +54,8 @@ from email.mime.text import MIMEText
 from email.mime.image import MIMEImage
 from email.header import Header
 
-from linkoauth.util import config, asbool, render
+from linkoauth.util import config, config_flag, render
+from linkoauth.util import time_left
 from linkoauth.util import safeHTML, literal
 from linkoauth.oid_extensions import OAuthRequest
 from linkoauth.oid_extensions import UIRequest
@@ -63,12 +64,26 @@ from linkoauth.openidconsumer import OpenIDResponder
 from linkoauth.oauth import get_oauth_config
 from linkoauth.protocap import ProtocolCapturingBase, OAuth2Requestor
 from linkoauth.errors import BackendError, OptionError, OAuthKeysException
+from linkoauth.errors import DeadlineExceededError
 
 GOOGLE_OAUTH = 'https://www.google.com/accounts/OAuthGetAccessToken'
 
 domain = 'google.com'
 
 
+def _get_consumer(config):
+    """Returns the shared oauth consumer of the Google config.
+
+    The Google keys are optional: without them a consumer is built with
+    their string values, as the requests always did.
+    """
+    try:
+        return config.consumer
+    except ValueError:
+        return oauth.Consumer(key=str(config.get('consumer_key')),
+                              secret=str(config.get('consumer_secret')))
+
+
 class GoogleConsumer(consumer.GenericConsumer):
     # a HACK to allow us to user google domains for federated login.
     # this doesn't do the proper discovery and validation, but since we
@@ -187,9 +202,8 @@ class GoogleResponder(OpenIDResponder):
 
     def _get_access_token(self, request_token):
         """Retrieve the access token if OAuth hybrid was used"""
-        consumer = oauth.Consumer(self.consumer_key, self.consumer_secret)
         token = oauth.Token(key=request_token, secret='')
-        client = oauth.Client(consumer, token)
+        client = OAuth2Requestor(_get_consumer(self.config), token)
         resp, content = client.request(GOOGLE_OAUTH, "POST")
         if resp['status'] != '200':
             return None
@@ -268,8 +282,29 @@ class SMTPRequestorImpl(SMTP, ProtocolCapturingBase):
     def __init__(self, host, port):
         self._record = []
         self.pc_host = host
-        SMTP.__init__(self, host, port)
+        timeout = time_left()
+        if timeout is None:
+            timeout = socket._GLOBAL_DEFAULT_TIMEOUT
         ProtocolCapturingBase.__init__(self)
+        try:
+            SMTP.__init__(self, host, port, timeout=timeout)
+        except socket.timeout:
+            self._check_deadline()
+            raise
+
+    def _set_timeout(self):
+        # every step gets the time left before the deadline
+        timeout = time_left()
+        if timeout is not None and getattr(self, 'sock', None) is not None:
+            self.sock.settimeout(timeout)
+
+    def _check_deadline(self):
+        # smtplib turns socket timeouts into disconnections
+        try:
+            time_left()
+        except DeadlineExceededError:
+            self.save_capture("deadline exceeded")
+            raise
 
     def pc_get_host(self):
         return self.pc_host
@@ -277,9 +312,15 @@ class SMTPRequestorImpl(SMTP, ProtocolCapturingBase):
     def send(self, str):
         msg = "> " + "\n+ ".join(str.splitlines()) + "\n"
         self._record.append(msg)
-        SMTP.send(self, str)
+        self._set_timeout()
+        try:
+            SMTP.send(self, str)
+        except smtplib.SMTPServerDisconnected:
+            self._check_deadline()
+            raise
 
     def getreply(self):
+        self._set_timeout()
         try:
             errcode, errmsg = SMTP.getreply(self)
         except Exception, exc:
@@ -290,6 +331,8 @@ class SMTPRequestorImpl(SMTP, ProtocolCapturingBase):
                 self._record.append("E " + json.dumps(erepr))
             except Exception:
                 log.exception("failed to serialize an SMTP exception")
+            if isinstance(exc, smtplib.SMTPServerDisconnected):
+                self._check_deadline()
             raise
 
         msg = "\n+ ".join(errmsg.splitlines()) + "\n"
@@ -298,7 +341,7 @@ class SMTPRequestorImpl(SMTP, ProtocolCapturingBase):
 
     def sendmail(self, *args, **kw):
         SMTP.sendmail(self, *args, **kw)
-        if asbool(config.get('protocol_capture_success')):
+        if config_flag('protocol_capture_success'):
             self.save_capture("automatic success save")
 
     def _save_capture(self, dirname):
@@ -326,8 +369,7 @@ class GoogleRequester(object):
             raise OAuthKeysException(str(e))
         self.consumer_key = str(self.config.get('consumer_key'))
         self.consumer_secret = str(self.config.get('consumer_secret'))
-        self.consumer = oauth.Consumer(key=self.consumer_key,
-                secret=self.consumer_secret)
+        self.consumer = _get_consumer(self.config)
 
     @classmethod
     def get_name(cls):
@@ -441,7 +483,7 @@ class GoogleRequester(object):
         try:
             server = SMTPRequestor(self.host, self.port)
             # in the app:main set debug = true to enable
-            if asbool(config.get('debug', False)):
+            if config_flag('debug'):
                 server.set_debuglevel(True)
             try:
                 try:
@@ -488,6 +530,9 @@ class GoogleRequester(object):
                     # an error above may have already disconnected, so we can
                     # ignore the error while quiting.
                     pass
+                except DeadlineExceededError:
+                    # no time left to say goodbye
+                    server.close()
         except smtplib.SMTPResponseException, exc:
             if server is not None:
                 server.save_capture("early smtp response exception")
@@ -505,10 +550,15 @@ class GoogleRequester(object):
 
         return result, error
 
+    def probe(self, headers=None):
+        # cheap authenticated call for the health prober, sending a mail
+        # is not an option
+        return self.getcontacts({'page': 1}, headers or {})
+
     def getgroup_id(self, group, headers):
         url = 'https://www.google.com/m8/feeds/groups/default/full?v=2'
         method = 'GET'
-        client = oauth.Client(self.consumer, self.oauth_token)
+        client = OAuth2Requestor(self.consumer, self.oauth_token)
         resp, content = client.request(url, method, headers=headers)
         feed = gdata.contacts.GroupsFeedFromString(content)
         for entry in feed.entry:
@@ -77,10 +77,9 @@ class responder(OAuth1):
                   'public-profile-url', 'site-standard-profile-request']
         fields = ','.join(fields)
         profile_url = "http://api.linkedin.com/v1/people/~:(%s)" % (fields,)
-        consumer = oauth.Consumer(self.consumer_key, self.consumer_secret)
         token = oauth.Token(access_token['oauth_token'],
                             access_token['oauth_token_secret'])
-        client = OAuth2Requestor(consumer, token)
+        client = OAuth2Requestor(self.consumer, token)
         headers = {}
         headers['x-li-format'] = 'json'
 
@@ -109,10 +108,9 @@ class api(object):
         except ValueError, e:
             # missing oauth tokens, raise our own exception
             raise OAuthKeysException(str(e))
-        self.consumer_key = self.config.get('consumer_key')
-        self.consumer_secret = self.config.get('consumer_secret')
-        self.consumer = oauth.Consumer(key=self.consumer_key,
-                                       secret=self.consumer_secret)
+        self.consumer_key = self.config.consumer_key
+        self.consumer_secret = self.config.consumer_secret
+        self.consumer = self.config.consumer
         self.sigmethod = oauth.SignatureMethod_HMAC_SHA1()
 
     @classmethod
@@ -226,6 +224,11 @@ class api(object):
 
         return self.rawcall(url, body, method="POST", headers=headers)
 
+    def probe(self, headers=None):
+        # cheap authenticated call for the health prober
+        url = "http://api.linkedin.com/v1/people/~:(id)"
+        return self.rawcall(url, method="GET", headers=headers)
+
     def getcontacts(self, options, headers):
         start = int(options.get('start', 0))
         page = int(options.get('page', 25))
@@ -148,10 +148,9 @@ class TwitterRequester(object):
         except ValueError, e:
             # missing oauth tokens, raise our own exception
             raise OAuthKeysException(str(e))
-        self.consumer_key = self.config.get('consumer_key')
-        self.consumer_secret = self.config.get('consumer_secret')
-        self.consumer = oauth.Consumer(key=self.consumer_key,
-                                       secret=self.consumer_secret)
+        self.consumer_key = self.config.consumer_key
+        self.consumer_secret = self.config.consumer_secret
+        self.consumer = self.config.consumer
         self.sigmethod = oauth.SignatureMethod_HMAC_SHA1()
 
     @classmethod
@@ -252,6 +251,10 @@ class TwitterRequester(object):
         url = 'https://api.twitter.com/1/account/verify_credentials.json'
         return self.rawcall(url)
 
+    def probe(self, headers=None):
+        # cheap authenticated call for the health prober
+        return self.profile()
+
     def getcontacts(self, options, headers):
         cursor = int(options.get('cursor', -1))
         url = ('https://api.twitter.com/1/statuses/followers.json'
@@ -31,12 +31,12 @@ import copy
 from rfc822 import AddressList
 import logging
 
-from linkoauth.util import asbool, render, safeHTML, literal, config
+from linkoauth.util import render, safeHTML, literal, config
 from linkoauth.oid_extensions import OAuthRequest
 from linkoauth.openidconsumer import ax_attributes, attributes
 from linkoauth.openidconsumer import OpenIDResponder
 from linkoauth.oauth import get_oauth_config
-from linkoauth.protocap import HttpRequestor
+from linkoauth.protocap import HttpRequestor, OAuth2Requestor
 from linkoauth.errors import (OptionError, OAuthKeysException,
                               ServiceUnavailableException)
 
@@ -60,9 +60,9 @@ class YahooResponder(OpenIDResponder):
         """
         OpenIDResponder.__init__(self, domain)
         self.domain = domain
-        self.consumer_key = self.config.get('consumer_key')
-        self.consumer_secret = self.config.get('consumer_secret')
-        if not asbool(self.config.get('verified')):
+        self.consumer_key = self.config.consumer_key
+        self.consumer_secret = self.config.consumer_secret
+        if not self.config.verified:
             self.return_to_query['domain_unverified'] = 1
         # yahoo openid only works in stateless mode,
         # do not use the openid_store
@@ -92,9 +92,8 @@ class YahooResponder(OpenIDResponder):
         return None
 
     def _get_access_token(self, request_token):
-        consumer = oauth.Consumer(self.consumer_key, self.consumer_secret)
         token = oauth.Token(key=request_token, secret='')
-        client = oauth.Client(consumer, token)
+        client = OAuth2Requestor(self.config.consumer, token)
         resp, content = client.request(YAHOO_OAUTH, "POST")
         if resp['status'] != '200':
             return None
@@ -129,10 +128,9 @@ class YahooRequester(object):
         except ValueError, e:
             # missing oauth tokens, raise our own exception
             raise OAuthKeysException(str(e))
-        self.consumer_key = self.config.get('consumer_key')
-        self.consumer_secret = self.config.get('consumer_secret')
-        self.consumer = oauth.Consumer(key=self.consumer_key,
-                                       secret=self.consumer_secret)
+        self.consumer_key = self.config.consumer_key
+        self.consumer_secret = self.config.consumer_secret
+        self.consumer = self.config.consumer
         self.sigmethod = oauth.SignatureMethod_HMAC_SHA1()
 
     @classmethod
@@ -323,6 +321,11 @@ class YahooRequester(object):
         return self.jsonrpc(self.endpoints['mail'],
                             'SendMessage', params, options, headers)
 
+    def probe(self, headers=None):
+        # cheap authenticated call for the health prober, sending a mail
+        # is not an option
+        return self.getcontacts({'count': 1}, headers)
+
     def getcontacts(self, options, headers):
         profile = self.account.get('profile', {})
         guid = profile.get('xoauth_yahoo_guid')
@@ -0,0 +1,324 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Raindrop.
+#
+# The Initial Developer of the Original Code is
+# Mozilla Messaging, Inc..
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+"""
+Benchmarks of the services status code that runs on every request.
+
+Two benchmarks are run for every combination of the options:
+
+- middleware: requests per second and latency of ServicesStatusMiddleware
+  in front of a trivial application, for a number of services, threads
+  and status states (healthy, failing, disabled)
+- update_status: writes per second and latency of
+  ServicesStatus.update_status, synchronous, async (queue_size) and
+  write-behind (flush_interval)
+
+By default the statuses are kept in a memory-mapped file in a temporary
+directory (see linkoauth.mmapcache), which stands in for memcached without
+any network noise. Use --servers to benchmark against a real memcached.
+
+The report is a JSON document. When given a baseline report with
+--compare, the exit status is 1 if a result got slower than the baseline
+by more than --tolerance.
+
+Example:
+
+    $ python -m linkoauth.bench --output bench.json
+    $ python -m linkoauth.bench --compare bench.json --tolerance .2
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import threading
+from optparse import OptionParser
+from timeit import default_timer
+
+from linkoauth.sstatus import ServicesStatus, ServicesStatusMiddleware
+
+
+STATES = ('healthy', 'failing', 'disabled')
+UPDATE_MODES = ('sync', 'async', 'write-behind')
+
+
+class _App(object):
+    def __call__(self, environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['OK']
+
+
+def _start_response(status, headers):
+    pass
+
+
+def _stats(latencies, elapsed):
+    """Returns the throughput and latency percentiles of a run."""
+    latencies.sort()
+    count = len(latencies)
+    res = {'calls': count, 'throughput': count / elapsed}
+    if not count:
+        res['latency'] = None
+        return res
+    res['latency'] = {'mean': sum(latencies) / count}
+    for name, percentile in (('p50', .5), ('p95', .95), ('p99', .99)):
+        res['latency'][name] = latencies[int(percentile * (count - 1))]
+    return res
+
+
+def _run(call, threads, duration):
+    """Calls `call(thread index, call index)` from `threads` threads for
+    `duration` seconds, and returns the stats of all the calls."""
+    results = [[] for i in range(threads)]
+    start = threading.Event()
+
+    def _worker(index):
+        latencies = results[index]
+        start.wait()
+        deadline = default_timer() + duration
+        count = 0
+        while True:
+            before = default_timer()
+            if before >= deadline:
+                break
+            call(index, count)
+            latencies.append(default_timer() - before)
+            count += 1
+
+    workers = [threading.Thread(target=_worker, args=(index,),
+                                name='sstatus-bench')
+               for index in range(threads)]
+    for worker in workers:
+        worker.start()
+    began = default_timer()
+    start.set()
+    for worker in workers:
+        worker.join()
+    elapsed = default_timer() - began
+    latencies = []
+    for result in results:
+        latencies.extend(result)
+    return _stats(latencies, elapsed)
+
+
+class Bench(object):
+    """Runs the benchmarks.
+
+    servers is the list of memcached servers to use, or None to use a
+    memory-mapped file.
+    """
+    def __init__(self, servers=None, duration=2.):
+        self.servers = servers
+        self.duration = duration
+        self._dir = None
+        self._stores = 0
+
+    def _backend(self, threads):
+        """Returns the options of a fresh status store used by `threads`
+        threads."""
+        if self.servers:
+            # pylibmc clients are not thread-safe, one client per thread
+            # plus one for the background thread of the status
+            return {'cache_servers': self.servers,
+                    'cache_pool_size': threads + 1}
+        if self._dir is None:
+            self._dir = tempfile.mkdtemp(prefix='sstatus-bench-')
+        self._stores += 1
+        return {'mmap_path': os.path.join(self._dir,
+                                          'status%d' % self._stores)}
+
+    def close(self):
+        if self._dir is not None:
+            shutil.rmtree(self._dir, ignore_errors=True)
+            self._dir = None
+
+    def middleware(self, services, threads, state):
+        names = ['service%d.com' % index for index in range(services)]
+        app = ServicesStatusMiddleware(_App(), names, [.5] * services,
+                                       **self._backend(threads))
+        status = app._status_checker
+        for name in names:
+            status.initialize(name)
+            if state == 'disabled':
+                status.disable(name)
+            elif state == 'failing':
+                status.update_counts(name, successes=10, failures=90)
+            else:
+                status.update_counts(name, successes=100)
+
+        environs = [{'HTTP_X_TARGET_DOMAIN': name} for name in names]
+
+        def _call(thread, count):
+            environ = environs[(thread + count) % services]
+            app(dict(environ), _start_response)
+
+        try:
+            return _run(_call, threads, self.duration)
+        finally:
+            status.close()
+
+    def update_status(self, services, threads, mode):
+        names = ['service%d.com' % index for index in range(services)]
+        options = self._backend(threads)
+        if 'cache_servers' in options:
+            options = {'servers': options['cache_servers'],
+                       'pool_size': options['cache_pool_size']}
+        if mode == 'async':
+            options['queue_size'] = 1000
+        elif mode == 'write-behind':
+            options['flush_interval'] = 1.
+        status = ServicesStatus(names, **options)
+
+        def _call(thread, count):
+            status.update_status(names[(thread + count) % services],
+                                 count % 10 != 0, .1)
+
+        try:
+            return _run(_call, threads, self.duration)
+        finally:
+            status.close()
+
+    def run(self, services=(1, 10, 50), threads=(1, 4, 16),
+            states=STATES, modes=UPDATE_MODES):
+        """Runs every combination and returns the report."""
+        results = []
+        try:
+            for count in services:
+                for thread_count in threads:
+                    for state in states:
+                        res = self.middleware(count, thread_count, state)
+                        res.update({'bench': 'middleware',
+                                    'services': count,
+                                    'threads': thread_count,
+                                    'variant': state})
+                        results.append(res)
+                    for mode in modes:
+                        res = self.update_status(count, thread_count, mode)
+                        res.update({'bench': 'update_status',
+                                    'services': count,
+                                    'threads': thread_count,
+                                    'variant': mode})
+                        results.append(res)
+        finally:
+            self.close()
+
+        backend = self.servers and 'memcached' or 'mmap'
+        return {'time': time.time(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'backend': backend,
+                'duration': self.duration,
+                'results': results}
+
+
+def _result_key(result):
+    return (result['bench'], result['services'], result['threads'],
+            result['variant'])
+
+
+def compare(report, baseline, tolerance=.2):
+    """Returns the list of the results of `report` that regressed from
+    `baseline` by more than `tolerance` (a ratio), as (key, reason)."""
+    previous = dict([(_result_key(result), result)
+                     for result in baseline['results']])
+    regressions = []
+    for result in report['results']:
+        key = _result_key(result)
+        if key not in previous:
+            continue
+        old = previous[key]
+        if result['throughput'] < old['throughput'] * (1 - tolerance):
+            regressions.append((key, 'throughput %.1f/s, was %.1f/s' %
+                                (result['throughput'], old['throughput'])))
+        if result['latency'] is None or old['latency'] is None:
+            continue
+        p95, old_p95 = result['latency']['p95'], old['latency']['p95']
+        if p95 > old_p95 * (1 + tolerance):
+            regressions.append((key, 'p95 %.6fs, was %.6fs' % (p95, old_p95)))
+    return regressions
+
+
+def _ints(value):
+    return [int(item) for item in value.split(',')]
+
+
+def main(args=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--servers', default=None,
+                      help='memcached servers, comma-separated. Uses a '
+                           'memory-mapped file by default')
+    parser.add_option('--services', default='1,10,50',
+                      help='numbers of services [%default]')
+    parser.add_option('--threads', default='1,4,16',
+                      help='numbers of threads [%default]')
+    parser.add_option('--states', default=','.join(STATES),
+                      help='middleware status states [%default]')
+    parser.add_option('--modes', default=','.join(UPDATE_MODES),
+                      help='update_status modes [%default]')
+    parser.add_option('--duration', type='float', default=2.,
+                      help='seconds per benchmark [%default]')
+    parser.add_option('--output', default=None,
+                      help='writes the report in this file, instead of '
+                           'stdout')
+    parser.add_option('--compare', default=None,
+                      help='baseline report to compare with')
+    parser.add_option('--tolerance', type='float', default=.2,
+                      help='accepted regression ratio [%default]')
+    options, args = parser.parse_args(args)
+
+    servers = options.servers and options.servers.split(',') or None
+    states = [state for state in options.states.split(',') if state]
+    modes = [mode for mode in options.modes.split(',') if mode]
+    for state in states:
+        if state not in STATES:
+            parser.error('unknown state %r' % state)
+    for mode in modes:
+        if mode not in UPDATE_MODES:
+            parser.error('unknown mode %r' % mode)
+
+    bench = Bench(servers, options.duration)
+    report = bench.run(_ints(options.services), _ints(options.threads),
+                       states, modes)
+
+    dumped = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as output:
+            output.write(dumped + os.linesep)
+    else:
+        print(dumped)
+
+    if options.compare:
+        with open(options.compare) as baseline:
+            regressions = compare(report, json.load(baseline),
+                                  options.tolerance)
+        for key, reason in regressions:
+            sys.stderr.write('%s %d services %d threads %s: %s\n'
+                             % (key + (reason,)))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -32,6 +32,19 @@ class BackendError(Exception):
     """
 
 
+class DeadlineExceededError(Exception):
+    """Happens when a call ran out of its time budget, see
+    linkoauth.util.deadline"""
+
+
+class CancelledError(Exception):
+    """Happens when getting the result of a cancelled task"""
+
+
+class TaskTimeoutError(Exception):
+    """Happens when a task is not done in time"""
+
+
 class DomainNotRegisteredError(Exception):
     pass
 
@@ -0,0 +1,303 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Raindrop.
+#
+# The Initial Developer of the Original Code is
+# Mozilla Messaging, Inc..
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+"""
+A memcached-like client that keeps its data in a memory-mapped file.
+
+All the processes of a host that map the same file share the data, so it
+can be used by ServicesStatus instead of memcached for single-host
+deployments (prefork workers), tests and benchmarks.
+
+The file is a fixed-size hash table with open addressing. Every operation
+holds a lock on the file, so read-modify-write operations such as incr,
+add or cas are atomic across threads and processes. Deleted and expired
+entries leave tombstones behind, the table is rehashed when a lookup has
+to step over too many of them.
+
+Only the calls and the value types (bool, int, short str) used by
+ServicesStatus are supported.
+"""
+import os
+import mmap
+import time
+import fcntl
+import struct
+import threading
+import zlib
+
+from pylibmc import NotFound, WriteError
+
+
+_MAGIC = 'SSTM'
+_HEADER = struct.Struct('!4sI')
+# state, key size, key, expiration, cas id, value type, value size, value
+_SLOT = struct.Struct('!BB80sdQBB26s')
+_SLOT_SIZE = 128
+_MAX_KEY = 80
+_MAX_VALUE = 26
+
+_EMPTY, _USED, _DELETED = 0, 1, 2
+# tombstones a lookup can step over before the table is rehashed
+_MAX_TOMBSTONES = 16
+_INT, _BOOL, _STR = 0, 1, 2
+_INT_VALUE = struct.Struct('!q')
+
+# the API uses `time` as an argument name
+_now = time.time
+
+
+def _encode(value):
+    if isinstance(value, bool):
+        return _BOOL, value and '\x01' or '\x00'
+    if isinstance(value, (int, long)):
+        return _INT, _INT_VALUE.pack(value)
+    if isinstance(value, str) and len(value) <= _MAX_VALUE:
+        return _STR, value
+    raise WriteError('unsupported value %r' % (value,))
+
+
+def _decode(kind, data):
+    if kind == _BOOL:
+        return data == '\x01'
+    if kind == _INT:
+        return _INT_VALUE.unpack(data[:_INT_VALUE.size])[0]
+    return data
+
+
+class MmapClient(object):
+    """Subset of the pylibmc client API backed by a memory-mapped file."""
+
+    def __init__(self, path, slots=4096):
+        self.path = path
+        self.behaviors = {}
+        self._lock = threading.RLock()
+        self._file = open(path, 'a+b')
+        fcntl.lockf(self._file, fcntl.LOCK_EX)
+        try:
+            self._file.seek(0, os.SEEK_END)
+            if self._file.tell() == 0:
+                size = _HEADER.size + slots * _SLOT_SIZE
+                self._file.write(_HEADER.pack(_MAGIC, slots))
+                self._file.write('\x00' * (size - _HEADER.size))
+                self._file.flush()
+            self._file.seek(0)
+            magic, self.slots = _HEADER.unpack(
+                self._file.read(_HEADER.size))
+            if magic != _MAGIC:
+                raise ValueError('%r is not a status file' % path)
+            self._map = mmap.mmap(self._file.fileno(), 0)
+        finally:
+            fcntl.lockf(self._file, fcntl.LOCK_UN)
+
+    def clone(self):
+        # the client is thread-safe
+        return self
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    # locking
+    def _acquire(self):
+        # fcntl locks are per-process, the thread lock is needed too
+        self._lock.acquire()
+        fcntl.lockf(self._file, fcntl.LOCK_EX)
+
+    def _release(self):
+        fcntl.lockf(self._file, fcntl.LOCK_UN)
+        self._lock.release()
+
+    # slots
+    def _offset(self, index):
+        return _HEADER.size + index * _SLOT_SIZE
+
+    def _read_slot(self, index):
+        offset = self._offset(index)
+        return _SLOT.unpack(self._map[offset:offset + _SLOT.size])
+
+    def _write_slot(self, index, key, value, expires, cas_id):
+        kind, data = _encode(value)
+        offset = self._offset(index)
+        self._map[offset:offset + _SLOT.size] = _SLOT.pack(
+            _USED, len(key), key, expires, cas_id, kind, len(data), data)
+
+    def _delete_slot(self, index):
+        offset = self._offset(index)
+        self._map[offset] = chr(_DELETED)
+
+    def _compact(self, now):
+        """Rehashes the live entries, which drops the tombstones."""
+        live = []
+        for index in range(self.slots):
+            slot = self._read_slot(index)
+            state, expires = slot[0], slot[3]
+            if state == _USED and not (expires and expires <= now):
+                live.append(slot)
+        self._map[_HEADER.size:] = '\x00' * (self.slots * _SLOT_SIZE)
+        for slot in live:
+            start = zlib.crc32(slot[2][:slot[1]]) % self.slots
+            for i in range(self.slots):
+                offset = self._offset((start + i) % self.slots)
+                if ord(self._map[offset]) == _EMPTY:
+                    self._map[offset:offset + _SLOT.size] = _SLOT.pack(*slot)
+                    break
+
+    def _find(self, key, now, compact=True):
+        """Returns (index of the key or None, first free index or None)"""
+        if len(key) > _MAX_KEY:
+            raise WriteError('key too long %r' % key)
+        free = None
+        tombstones = 0
+        start = zlib.crc32(key) % self.slots
+        for i in range(self.slots):
+            index = (start + i) % self.slots
+            state, size, slot_key, expires, cas_id, kind, vsize, data = \
+                self._read_slot(index)
+            if state == _EMPTY:
+                if free is None:
+                    free = index
+                break
+            if state == _USED and expires and expires <= now:
+                # expired, the slot can be reused
+                self._delete_slot(index)
+                state = _DELETED
+            if state == _DELETED:
+                tombstones += 1
+                if free is None:
+                    free = index
+                continue
+            if slot_key[:size] == key:
+                return index, free
+
+        if compact and tombstones > _MAX_TOMBSTONES:
+            # the misses got slow
+            self._compact(now)
+            return self._find(key, now, compact=False)
+        return None, free
+
+    def _get(self, key, now):
+        index, free = self._find(key, now)
+        if index is None:
+            return None, None
+        state, size, slot_key, expires, cas_id, kind, vsize, data = \
+            self._read_slot(index)
+        return _decode(kind, data[:vsize]), cas_id
+
+    def _set(self, key, value, ttl, now):
+        index, free = self._find(key, now)
+        if index is None:
+            if free is None:
+                raise WriteError('the status file is full')
+            index, cas_id = free, 0
+        else:
+            cas_id = self._read_slot(index)[4]
+        expires = ttl and now + ttl or 0
+        self._write_slot(index, key, value, expires, cas_id + 1)
+
+    # API
+    def get(self, key):
+        self._acquire()
+        try:
+            return self._get(key, _now())[0]
+        finally:
+            self._release()
+
+    def get_multi(self, keys):
+        self._acquire()
+        try:
+            now = _now()
+            res = {}
+            for key in keys:
+                value = self._get(key, now)[0]
+                if value is not None:
+                    res[key] = value
+            return res
+        finally:
+            self._release()
+
+    def gets(self, key):
+        self._acquire()
+        try:
+            return self._get(key, _now())
+        finally:
+            self._release()
+
+    def set(self, key, value, time=0):
+        self._acquire()
+        try:
+            self._set(key, value, time, _now())
+            return True
+        finally:
+            self._release()
+
+    def add(self, key, value, time=0):
+        self._acquire()
+        try:
+            now = _now()
+            if self._get(key, now)[0] is not None:
+                return False
+            self._set(key, value, time, now)
+            return True
+        finally:
+            self._release()
+
+    def add_multi(self, mapping, time=0):
+        return [key for key, value in mapping.items()
+                if not self.add(key, value, time=time)]
+
+    def cas(self, key, value, cas_id, time=0):
+        self._acquire()
+        try:
+            now = _now()
+            if self._get(key, now)[1] != cas_id:
+                return False
+            self._set(key, value, time, now)
+            return True
+        finally:
+            self._release()
+
+    def incr(self, key, delta=1):
+        self._acquire()
+        try:
+            now = _now()
+            index, free = self._find(key, now)
+            if index is None:
+                raise NotFound(key)
+            state, size, slot_key, expires, cas_id, kind, vsize, data = \
+                self._read_slot(index)
+            value = _decode(kind, data[:vsize]) + delta
+            self._write_slot(index, key, value, expires, cas_id + 1)
+            return value
+        finally:
+            self._release()
+
+    def delete_multi(self, keys):
+        self._acquire()
+        try:
+            now = _now()
+            for key in keys:
+                index, free = self._find(key, now)
+                if index is not None:
+                    self._delete_slot(index)
+            return True
+        finally:
+            self._release()
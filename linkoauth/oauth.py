@@ -33,22 +33,59 @@ import logging
 
 import oauth2 as oauth
 
-from linkoauth.util import config, redirect, asbool, build_url
-from linkoauth.protocap import HttpRequestor
+from linkoauth.util import redirect, asbool, build_url, get_config_index
+from linkoauth.protocap import HttpRequestor, OAuth2Requestor
 from linkoauth.errors import BadVersionError, AccessException
 
 
 log = logging.getLogger("oauth.base")
 
 
+class ProviderConfig(dict):
+    """Read-only options of a provider (the oauth.<provider>.* options,
+    without the prefix), with the parsed values and a shared oauth
+    consumer."""
+    def __init__(self, provider, options):
+        dict.__init__(self, options)
+        self.provider = provider
+        self.consumer_key = options.get('consumer_key')
+        self.consumer_secret = options.get('consumer_secret')
+        self.verified = asbool(options.get('verified', False))
+        if 'version' in options:
+            self.version = int(options['version'])
+        else:
+            self.version = None
+        self._consumer = None
+
+    @property
+    def consumer(self):
+        if self._consumer is None:
+            self._consumer = oauth.Consumer(key=self.consumer_key,
+                                            secret=self.consumer_secret)
+        return self._consumer
+
+    def _read_only(self, *args, **kw):
+        raise TypeError('the configuration of %s is read-only' %
+                        self.provider)
+
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+
 def get_oauth_config(provider):
-    key = 'oauth.%s.' % provider
-    keylen = len(key)
-    d = {}
-    for k, v in config.items():
-        if k.startswith(key):
-            d[k[keylen:]] = v
-    return d
+    """Returns the ProviderConfig of a provider.
+
+    It is built once per configuration, see linkoauth.util.setup_config.
+    """
+    index = get_config_index()
+    key = 'oauth', provider
+    try:
+        return index.derived[key]
+    except KeyError:
+        provider_config = ProviderConfig(provider,
+                                         index.section('oauth.' + provider))
+        index.derived[key] = provider_config
+        return provider_config
 
 
 class OAuth1(object):
@@ -58,13 +95,15 @@ class OAuth1(object):
         self.request_token_url = self.config.get('request')
         self.access_token_url = self.config.get('access')
         self.authorization_url = self.config.get('authorize')
-        self.version = int(self.config.get('version', '1'))
+        self.version = self.config.version
+        if self.version is None:
+            self.version = 1
         self.scope = self.config.get('scope', None)
         if self.version != 1:
             raise BadVersionError(self.version)
-        self.consumer_key = self.config.get('consumer_key')
-        self.consumer_secret = self.config.get('consumer_secret')
-        self.consumer = oauth.Consumer(self.consumer_key, self.consumer_secret)
+        self.consumer_key = self.config.consumer_key
+        self.consumer_secret = self.config.consumer_secret
+        self.consumer = self.config.consumer
         self.sigmethod = oauth.SignatureMethod_HMAC_SHA1()
 
     def request_access(self, request, url, session):
@@ -115,7 +154,7 @@ class OAuth1(object):
             redirect(self.config.get('oauth_failure'))
 
         request_token.set_verifier(verifier)
-        client = oauth.Client(self.consumer, request_token)
+        client = OAuth2Requestor(self.consumer, request_token)
         resp, content = client.request(self.access_token_url, "POST")
         if resp['status'] != '200':
             redirect(self.config.get('oauth_failure'))
@@ -133,7 +172,9 @@ class OAuth2(object):
         self.config = get_oauth_config(provider)
         self.access_token_url = self.config.get('access')
         self.authorization_url = self.config.get('authorize')
-        self.version = int(self.config.get('version', '2'))
+        self.version = self.config.version
+        if self.version is None:
+            self.version = 2
         if self.version != 2:
             raise BadVersionError(self.version)
         self.app_id = self.config.get('app_id')
@@ -22,6 +22,7 @@
 #
 import logging
 import re
+import threading
 
 from openid.consumer import consumer
 from openid.extensions import ax, sreg
@@ -192,6 +193,57 @@ def extract_openid_data(identifier, sreg_resp, ax_resp):
     return ud
 
 
+class LockedStore(object):
+    """Serializes the calls to an OpenID store that is not thread-safe,
+    such as the MemoryStore."""
+    def __init__(self, store):
+        self._store = store
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attr = getattr(self._store, name)
+        if not callable(attr):
+            return attr
+
+        def _locked(*args, **kw):
+            with self._lock:
+                return attr(*args, **kw)
+        return _locked
+
+
+# the stores live as long as the process, so the associations and nonces
+# are kept from a request to the next one
+_STORES = {}
+_STORES_LOCK = threading.Lock()
+
+
+def get_openid_store(provider):
+    """Returns the OpenID store of a provider, as set by the openid_store
+    and openid_store_path options, shared by the whole process."""
+    store = config.get('openid_store', 'mem')
+    if store == u"file":
+        store_file_path = config.get('openid_store_path', None)
+        key = store, store_file_path
+    elif store == u"mem":
+        key = store, provider
+    elif store == u"sql":
+        # TODO: This does not work as we need a connection, not a string
+        # XXX
+        #self.openid_store = sqlstore.SQLStore(sql_connstring,
+        #        sql_associations_table, sql_connstring)
+        raise NotImplementedError()
+    else:
+        raise ValueError('unknown openid_store %r' % store)
+
+    with _STORES_LOCK:
+        if key not in _STORES:
+            if store == u"file":
+                _STORES[key] = filestore.FileOpenIDStore(store_file_path)
+            else:
+                _STORES[key] = LockedStore(memstore.MemoryStore())
+        return _STORES[key]
+
+
 class OpenIDResponder(object):
     """OpenID Consumer for handling OpenID authentication
     """
@@ -206,18 +258,7 @@ class OpenIDResponder(object):
         self.endpoint_regex = self.config.get('endpoint_regex')
 
         # application config items, dont use self.config
-        store = config.get('openid_store', 'mem')
-        if store == u"file":
-            store_file_path = config.get('openid_store_path', None)
-            self.openid_store = filestore.FileOpenIDStore(store_file_path)
-        elif store == u"mem":
-            self.openid_store = memstore.MemoryStore()
-        elif store == u"sql":
-            # TODO: This does not work as we need a connection, not a string
-            # XXX
-            #self.openid_store = sqlstore.SQLStore(sql_connstring,
-            #        sql_associations_table, sql_connstring)
-            raise NotImplementedError()
+        self.openid_store = get_openid_store(provider)
 
         self.scope = self.config.get('scope', None)
         self.return_to_query = {}
@@ -0,0 +1,200 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Raindrop.
+#
+# The Initial Developer of the Original Code is
+# Mozilla Messaging, Inc..
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+"""
+Synthetic health probing of the providers.
+
+ServicesProber calls every provider on a schedule with a dedicated probe
+account, using the cheap `probe` call of its requester (Twitter
+verify_credentials, Facebook /me, ...), and feeds the results to the
+services status like real traffic does. Outages are detected, and
+recoveries confirmed, without spending user requests.
+
+In-process, start it with the Services instance of the application:
+
+    prober = ServicesProber(services, {'twitter.com': account, ...})
+    prober.start()
+
+Every process can run one: each provider is probed by a single process of
+the cluster per interval (see ServicesStatus.claim).
+
+As a sidecar, run this module with an ini file:
+
+    $ python -m linkoauth.prober prober.ini
+
+    [prober]
+    servers = 127.0.0.1:11211
+    interval = 60
+    # seconds given to each probe
+    timeout = 10
+    # JSON mapping of domain -> account (oauth_token, ...)
+    accounts = /etc/f1/probe-accounts.json
+    # and the oauth.* options of the application
+    oauth.twitter.com.consumer_key = ...
+"""
+import sys
+import json
+import time
+import logging
+import threading
+from ConfigParser import RawConfigParser
+
+from linkoauth.backends import get_requester
+from linkoauth.sstatus import ServicesStatus
+from linkoauth.errors import OAuthKeysException
+from linkoauth.errors import StatusReadError, StatusWriteError
+from linkoauth.util import setup_config, deadline
+
+
+log = logging.getLogger(__name__)
+
+# the provider refused the probe account, this is not an outage
+_CREDENTIALS_ERRORS = (401, 403)
+
+
+class ServicesProber(object):
+    """Probes the providers of `accounts`, a mapping of domain -> probe
+    account, every `interval` seconds and reports the results to `status`,
+    a ServicesStatus.
+
+    Each probe gets `timeout` seconds (see linkoauth.util.deadline), so a
+    provider that hangs counts as a failure and does not hold back the
+    probes of the others.
+
+    The last result of each provider is kept in `results`, as a mapping of
+    domain -> (time, success, latency, error).
+    """
+    def __init__(self, status, accounts, interval=60., timeout=10.):
+        self.status = status
+        self.accounts = accounts
+        self.interval = interval
+        self.timeout = timeout
+        self.results = {}
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def probe(self, domain):
+        """Calls the provider and returns (success, error).
+
+        success is None when the result says nothing about the health of
+        the provider, e.g. when the probe account has been revoked.
+        """
+        try:
+            requester = get_requester(domain, self.accounts[domain])
+            probe = getattr(requester, 'probe', None)
+            if probe is None:
+                return None, 'no probe call for %s' % domain
+            result, error = probe()
+        except OAuthKeysException, e:
+            return None, 'bad probe account: %s' % e
+        except Exception, e:
+            # network errors and provider errors alike
+            return False, str(e)
+
+        if error is None:
+            return True, None
+        if isinstance(error, dict) and \
+           error.get('status') in _CREDENTIALS_ERRORS:
+            return None, 'probe account refused: %s' % error.get('message')
+        return False, error
+
+    def tick(self, now=None):
+        """Probes the providers that no other process probed during the
+        current interval."""
+        if now is None:
+            now = time.time()
+        for domain in self.accounts:
+            try:
+                if not self.status.claim('probe:%s' % domain, self.interval,
+                                         now):
+                    continue
+            except StatusWriteError:
+                log.warn('could not reach the status cache, probing %s '
+                         'anyway' % domain)
+
+            start = time.time()
+            with deadline(start + self.timeout):
+                success, error = self.probe(domain)
+            latency = time.time() - start
+            self.results[domain] = start, success, latency, error
+            if success is None:
+                log.error('could not probe %s: %s' % (domain, error))
+                continue
+            if not success:
+                log.warn('probe of %s failed: %s' % (domain, error))
+            try:
+                self.status.update_status(domain, success, latency)
+            except (StatusReadError, StatusWriteError):
+                log.warn('could not update the status of %s' % domain)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self.tick()
+            self._stopped.wait(self.interval)
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='sstatus-prober')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    if len(args) != 1:
+        print('Usage: prober config.ini')
+        return 1
+
+    parser = RawConfigParser()
+    parser.read(args)
+    options = dict(parser.items('prober'))
+    setup_config(options)
+
+    with open(options['accounts']) as accounts:
+        accounts = json.load(accounts)
+
+    servers = options.get('servers', '127.0.0.1:11211').split(',')
+    status = ServicesStatus(accounts.keys(), servers,
+                            mmap_path=options.get('mmap_path'))
+    prober = ServicesProber(status, accounts,
+                            float(options.get('interval', 60.)),
+                            float(options.get('timeout', 10.)))
+    try:
+        while True:
+            prober.tick()
+            time.sleep(prober.interval)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
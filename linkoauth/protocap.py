@@ -24,13 +24,14 @@ import os
 import json
 import httplib2
 import random
+import socket
 import time
 import logging
 import urlparse
 
 import oauth2
-from linkoauth.errors import OptionError
-from linkoauth.util import config, asbool
+from linkoauth.errors import OptionError, DeadlineExceededError
+from linkoauth.util import config, config_flag, current_deadline, time_left
 
 log = logging.getLogger(__name__)
 
@@ -101,6 +102,13 @@ class RecordingHttpBase(object):
         this_con = {'path': request_uri, 'method': method, 'body': body,
                     'headers': headers}
         connections.append(this_con)
+        # every connection attempt gets the time left before the deadline,
+        # for connecting and reading alike
+        timeout = time_left()
+        if timeout is not None:
+            conn.timeout = timeout
+            if getattr(conn, 'sock', None) is not None:
+                conn.sock.settimeout(timeout)
         try:
             klass = super(RecordingHttpBase, self)
             response, content = klass._conn_request(conn, request_uri,
@@ -136,9 +144,15 @@ class HttpRequestor(ProtocolCapturingBase):
         return urlparse.urlparse(self.http.capture['uri']).netloc
 
     def request(self, uri, method="GET", body='', headers=None):
-        response, data = self.http.request(uri, method, body, headers)
+        try:
+            response, data = self.http.request(uri, method, body, headers)
+        except socket.timeout:
+            if current_deadline() is None:
+                raise
+            self.save_capture("deadline exceeded")
+            raise DeadlineExceededError('%s timed out' % self.pc_get_host())
         if (300 > int(response['status']) >= 200 and
-            asbool(config.get('protocol_capture_success'))):
+            config_flag('protocol_capture_success')):
             self.save_capture("automatic success save")
         return response, data
 
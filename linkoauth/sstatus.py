@@ -31,6 +31,13 @@ This module provides:
   The rejection is based on the presence of a X-Target-Service header
   and the value of the successes/failures ratio in the DB.
 
+  The Retry-After header of the rejections grows with the share of
+  failures and is jittered, and a service that recovers can get its
+  traffic back progressively (see ramp_duration).
+
+  The requests can also be capped per service with token buckets shared
+  by all the processes through the DB (see rate_limits and TokenLease).
+
   Note that it's better to reject the requests earlier in the stack
   if you can (at the load balancer level for instance) to avoid
   extra CPU cycles for this.
@@ -41,56 +48,374 @@ This module provides:
   - disable(service) -> True or False
   - enable(service) -> True or False
   - get_status(service_name) -> status, successes, failures
-  - update_status(service_name, success_or_failure) -> True or False
+  - get_statuses(service_names) -> {service_name: (status, successes,
+    failures)}, read in a single round trip
+  - get_buckets(service_names) -> {service_name: (status, buckets)}
+  - get_latencies(service_names) -> {service_name: histogram}
+  - lease_tokens(service_name, rate, capacity, count) -> tokens granted
+  - get_history(service_names) -> {service_name: snapshots}
+  - update_status(service_name, success_or_failure, latency) -> True or
+    False
+  - update_counts(service_name, successes, failures)
+
+  When created with packed=True, the status of a service is stored in a
+  single binary record (enabled flag, successes, failures, start of the
+  window) read with one get and updated with gets/cas.
+
+  When created with a pool_size, the memcached clients are checked out of
+  a bounded pool so the class can be shared by several threads. A pool of
+  BACKGROUND_POOL_SIZE clients is used by default when a background
+  thread (write-behind, async updates, history) shares the class.
+
+  When created with a mmap_path, the statuses are kept in a memory-mapped
+  file shared by all the processes of the host instead of memcached.
+
+  update_status also takes the latency of the call, which is counted in a
+  histogram per service (see get_latencies, get_health and
+  latency_percentile). The middleware can reject the requests of a service
+  whose latency percentile gets over a treshold.
+
+  After cache_max_errors consecutive errors, the cache is considered down
+  and the calls fail right away with StatusReadError or StatusWriteError
+  until a background probe reaches it again (see ConnectionHealth).
+
+  When created with a history_size, a snapshot of the counters, latency
+  and rejections of every service is appended to a ring every
+  history_interval seconds (see get_history and linkoauth.trends).
+
+  When created with a queue_size, update_status only pushes the update on
+  a bounded queue drained by a background thread, dropping the oldest
+  updates when the queue is full (see update_stats).
+
+  When created with a flush_interval, update_status aggregates the
+  successes and failures in memory and a background thread writes them
+  every flush_interval seconds or every flush_events updates.
 
 
 The statuses are saved in a membase backend that can be replicated around
-using the peer-to-peer replication feature.
+using the peer-to-peer replication feature, or in a memory-mapped file for
+single-host deployments (see linkoauth.mmapcache).
+
+When created with a bucket_size, ServicesStatus keeps the counters in a
+sliding window made of a ring of time buckets, and the middleware
+drives a closed/open/half-open CircuitBreaker per service with it.
+
+The middleware can optionally keep a process-local snapshot of all the
+statuses, refreshed by a background thread, so that checking a request
+does not require any I/O.
 """
 import sys
+import math
+import time
+import random
+import struct
+import Queue
+import logging
+import threading
+from collections import deque
 from functools import wraps
 
 from pylibmc import Client, SomeErrors, WriteError
+from pylibmc import ConnectionError, ServerDown, MemcachedError
 from _pylibmc import NotFound
 
 from linkoauth.errors import StatusReadError, StatusWriteError
+from linkoauth.mmapcache import MmapClient
+
+
+log = logging.getLogger(__name__)
 
 
 def _key(*args):
     return ':'.join(args)
 
 
+# packed layout: enabled flag, successes, failures, window start
+_RECORD = struct.Struct('!BIIL')
+
+
+def _pack_status(enabled, succ, fail, start):
+    return _RECORD.pack(bool(enabled), succ, fail, int(start))
+
+
+def _unpack_status(data):
+    enabled, succ, fail, start = _RECORD.unpack(data)
+    return bool(enabled), succ, fail, start
+
+
+# token bucket: tokens left, time of the last refill
+_TOKENS = struct.Struct('!dd')
+
+# history snapshot: time, successes, failures, p95 latency, rejects, window
+# (whole seconds covered by the counts in sliding window mode, 0 when the
+# counters only grow until they are reset). It has to fit in the 26 bytes
+# values of the shared-memory backend.
+_SNAPSHOT = struct.Struct('!dIIfIH')
+_MAX_WINDOW = 0xffff
+
+
+# upper bounds, in seconds, of the latency histogram bins. The histogram
+# has one more bin for the slower calls.
+LATENCY_BINS = (.05, .1, .25, .5, 1., 2.5, 5., 10., 20.)
+
+
+def latency_bin(latency):
+    """Returns the index of the histogram bin of a latency."""
+    for index, bound in enumerate(LATENCY_BINS):
+        if latency <= bound:
+            return index
+    return len(LATENCY_BINS)
+
+
+def latency_percentile(histogram, percentile):
+    """Returns the upper bound of the bin that holds the given percentile
+    (0.95 for p95) of a histogram, or None if the histogram is empty.
+
+    float('inf') is returned for the slower calls bin.
+    """
+    total = sum(histogram)
+    if total == 0:
+        return None
+    target = percentile * total
+    seen = 0
+    for index, count in enumerate(histogram):
+        seen += count
+        if seen >= target and count:
+            break
+    if index < len(LATENCY_BINS):
+        return LATENCY_BINS[index]
+    return float('inf')
+
+
 def cache_initialized(fn):
     @wraps(fn)
     def initializer(self, *args, **kwargs):
-        if getattr(self, '_initialized', False):
-            # already initialized, scrap the decorator
-            setattr(self, fn.__name__, fn)
-        else:
-            for service in self.services:
-                # initialize if not found
-                try:
-                    enabled = self._cache.get(_key('service', service, 'on'))
-                except SomeErrors:
-                    raise StatusReadError()
-                if enabled is None:
-                    self.initialize(service)
+        if not self._initialized:
+            self.initialize_all()
         return fn(self, *args, **kwargs)
     return initializer
 
 
+class ConnectionHealth(object):
+    """Mini circuit breaker for the connection to the cache.
+
+    After `max_errors` consecutive errors the cache is considered down for
+    `backoff` seconds, doubled after every failed probe up to
+    `max_backoff`. While it is down, the calls fail right away instead of
+    waiting for a timeout, and a background thread calls `probe` to
+    detect when the cache is back.
+    """
+    def __init__(self, probe, max_errors=3, backoff=1., max_backoff=30.):
+        self.probe = probe
+        self.max_errors = max_errors
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.errors = 0
+        self.down = False
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def success(self):
+        self.errors = 0
+
+    def failure(self):
+        with self._lock:
+            self.errors += 1
+            if self.down or self.errors < self.max_errors:
+                return
+            log.warn('the status cache is down, backing off')
+            self.down = True
+            self._thread = threading.Thread(target=self._run,
+                                            name='sstatus-probe')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        backoff = self.backoff
+        while True:
+            time.sleep(backoff)
+            try:
+                self.probe()
+            except MemcachedError:
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            with self._lock:
+                log.info('the status cache is back')
+                self.errors = 0
+                self.down = False
+                self._thread = None
+            return
+
+
+def guarded(error):
+    """Skips the call and raises `error` while the cache is down, and
+    converts the cache errors into `error`."""
+    def decorator(fn):
+        @wraps(fn)
+        def _guarded(self, *args, **kwargs):
+            if self.health.down:
+                raise error()
+            try:
+                res = fn(self, *args, **kwargs)
+            except NotFound:
+                self.health.success()
+                raise
+            except MemcachedError:
+                self.health.failure()
+                raise error()
+            self.health.success()
+            return res
+        return _guarded
+    return decorator
+
+
+# size of the pool created when a background thread shares the client
+BACKGROUND_POOL_SIZE = 10
+
+
+def _pooled(name):
+    def method(self, *args, **kwargs):
+        return self._call(name, *args, **kwargs)
+    method.__name__ = name
+    return method
+
+
+class ClientPool(object):
+    """Bounded pool of memcached clients.
+
+    pylibmc clients are not thread-safe, so every call checks a clone of
+    the master client out of the pool, and blocks when all the clients
+    are in use. A client that lost its connection is replaced by a fresh
+    clone.
+    """
+    def __init__(self, master, size=BACKGROUND_POOL_SIZE):
+        self.master = master
+        self.size = size
+        self._clients = Queue.Queue(size)
+        for i in range(size):
+            self._clients.put(master.clone())
+
+    def _call(self, name, *args, **kwargs):
+        client = self._clients.get()
+        try:
+            return getattr(client, name)(*args, **kwargs)
+        except (ConnectionError, ServerDown):
+            # reconnect on the next call
+            client = self.master.clone()
+            raise
+        finally:
+            self._clients.put(client)
+
+    get = _pooled('get')
+    get_multi = _pooled('get_multi')
+    gets = _pooled('gets')
+    set = _pooled('set')
+    cas = _pooled('cas')
+    add = _pooled('add')
+    add_multi = _pooled('add_multi')
+    incr = _pooled('incr')
+    delete_multi = _pooled('delete_multi')
+
+
 class ServicesStatusCache(object):
     """Thin wrapper around cache client to allow for graceful initialization"""
-    def __init__(self, servers, services, ttl, binary):
+    def __init__(self, servers, services, ttl, binary, packed=False,
+                 pool_size=None, mmap_path=None, max_errors=3, backoff=1.,
+                 max_backoff=30., init_missing=True):
         self.services = services
         self.ttl = ttl
-        self._cache = Client(servers, binary=binary)
-        self._cache.behaviors = {"no_block": True}
+        self.packed = packed
+        # read-only clients do not add the missing statuses
+        self.init_missing = init_missing
+        if mmap_path is not None:
+            # shared memory instead of memcached
+            client = self._cache = MmapClient(mmap_path)
+        else:
+            client = self._cache = Client(servers, binary=binary)
+            self._cache.behaviors = {"no_block": True, "cas": True}
+            if pool_size:
+                self._cache = ClientPool(self._cache, pool_size)
+        # the probe runs in its own thread, with its own client
+        self._probe_client = client.clone()
+        self.health = ConnectionHealth(self._probe, max_errors, backoff,
+                                       max_backoff)
+        self._initialized = not init_missing
+        self._init_lock = threading.Lock()
+        if not init_missing:
+            return
+        try:
+            self._initialize_all()
+        except (StatusReadError, StatusWriteError):
+            # we will try again on the first call
+            log.warn('could not initialize the services statuses')
+
+    def _probe(self):
+        self._probe_client.get(_key('service', 'probe'))
+
+    def _check_key(self, service):
+        if self.packed:
+            return _key('service', service)
+        return _key('service', service, 'on')
 
+    @guarded(StatusReadError)
+    def _initialize_all(self):
+        self.initialize_all()
+
+    def initialize_all(self):
+        """Initializes the services that are not found in the cache.
+
+        This is done once with a get_multi and add_multi calls. add will
+        not overwrite the values another client might have written in the
+        meantime.
+        """
+        with self._init_lock:
+            if self._initialized:
+                return
+
+            keys = dict([(self._check_key(service), service)
+                         for service in self.services])
+            try:
+                found = self._cache.get_multi(keys.keys())
+            except SomeErrors:
+                raise StatusReadError()
+
+            missing = [service for key, service in keys.items()
+                       if key not in found]
+            if missing:
+                try:
+                    if self.packed:
+                        record = _pack_status(True, 0, 0, time.time())
+                        self._cache.add_multi(
+                            dict([(_key('service', service), record)
+                                  for service in missing]))
+                    else:
+                        flags, counters = {}, {}
+                        for service in missing:
+                            flags[_key('service', service, 'on')] = True
+                            counters[_key('service', service, 'succ')] = 0
+                            counters[_key('service', service, 'fail')] = 0
+                        self._cache.add_multi(flags)
+                        self._cache.add_multi(counters, time=self.ttl)
+                except WriteError:
+                    raise StatusWriteError()
+
+            self._initialized = True
+
+    def lost(self, service):
+        """Called when the keys of a service are missing, e.g. after a
+        restart or an eviction: they are added back on the next call."""
+        if self.init_missing and service in self.services:
+            self._initialized = False
+
+    @guarded(StatusWriteError)
     def initialize(self, service):
-        # XXX see if one key is better wrt R/W numbers
-        # to do a single memcached call here
         try:
+            if self.packed:
+                # a single record, see ServicesStatus
+                self._cache.set(_key('service', service),
+                                _pack_status(True, 0, 0, time.time()))
+                return True
+
             self._cache.set(_key('service', service, 'on'), True)
             self._cache.set(_key('service', service, 'succ'), 0,
                             time=self.ttl)
@@ -100,94 +425,1100 @@ class ServicesStatusCache(object):
         except WriteError:
             raise StatusWriteError()
 
+    @guarded(StatusReadError)
     @cache_initialized
     def get(self, key):
         return self._cache.get(key)
 
+    @guarded(StatusReadError)
+    @cache_initialized
+    def get_multi(self, keys):
+        return self._cache.get_multi(keys)
+
+    @guarded(StatusWriteError)
     @cache_initialized
     def set(self, key, *args, **kwargs):
         return self._cache.set(key, *args, **kwargs)
 
+    @guarded(StatusWriteError)
     @cache_initialized
-    def incr(self, key):
-        return self._cache.incr(key)
+    def gets(self, key):
+        return self._cache.gets(key)
+
+    @guarded(StatusWriteError)
+    @cache_initialized
+    def cas(self, key, *args, **kwargs):
+        return self._cache.cas(key, *args, **kwargs)
+
+    @guarded(StatusWriteError)
+    @cache_initialized
+    def add(self, key, *args, **kwargs):
+        return self._cache.add(key, *args, **kwargs)
+
+    @guarded(StatusWriteError)
+    @cache_initialized
+    def incr(self, key, delta=1):
+        return self._cache.incr(key, delta)
+
+    @guarded(StatusWriteError)
+    @cache_initialized
+    def delete_multi(self, keys):
+        return self._cache.delete_multi(keys)
+
+
+class StatusAggregator(object):
+    """Aggregates successes and failures in memory and writes them behind.
+
+    The deltas are flushed by a background thread every `interval`
+    seconds, or as soon as `max_events` updates were collected.
+    """
+    def __init__(self, status, interval=1., max_events=100):
+        self.status = status
+        self.interval = interval
+        self.max_events = max_events
+        self._deltas = {}
+        self._events = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def add(self, service, success, latency=None):
+        with self._lock:
+            deltas = self._deltas.setdefault(service, [0, 0, {}])
+            if success:
+                deltas[0] += 1
+            else:
+                deltas[1] += 1
+            if latency is not None:
+                index = latency_bin(latency)
+                deltas[2][index] = deltas[2].get(index, 0) + 1
+            self._events += 1
+            full = self._events >= self.max_events
+        if full:
+            self._wakeup.set()
+
+    def _merge(self, deltas):
+        with self._lock:
+            for service, (succ, fail, bins) in deltas.items():
+                current = self._deltas.setdefault(service, [0, 0, {}])
+                current[0] += succ
+                current[1] += fail
+                for index, count in bins.items():
+                    current[2][index] = current[2].get(index, 0) + count
+
+    def flush(self):
+        with self._lock:
+            deltas, self._deltas = self._deltas, {}
+            self._events = 0
+
+        while deltas:
+            service, (succ, fail, bins) = deltas.popitem()
+            try:
+                self.status.update_counts(service, succ, fail)
+            except StatusWriteError:
+                # keep what was not written for the next flush
+                log.warn('could not flush the services statuses')
+                deltas[service] = [succ, fail, bins]
+                self._merge(deltas)
+                return False
+            try:
+                if bins:
+                    self.status.update_latencies(service, bins)
+            except StatusWriteError:
+                # the latencies are not worth a double count of the
+                # successes and failures
+                log.warn('could not flush the services latencies')
+        return True
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def start(self):
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='sstatus-aggregator')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops the thread and flushes what is left."""
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+
+class StatusQueue(object):
+    """Bounded queue of status updates drained by a background thread.
+
+    When the queue is full the oldest update is dropped, so queuing an
+    update never blocks. `dropped`, `written` and `failed` count what
+    happened to the updates.
+    """
+    def __init__(self, status, maxsize=1000):
+        self.status = status
+        self.maxsize = maxsize
+        self.dropped = self.written = self.failed = 0
+        self._items = deque()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+    def put(self, service, success, latency=None):
+        with self._cond:
+            if len(self._items) >= self.maxsize:
+                self._items.popleft()
+                self.dropped += 1
+            self._items.append((service, success, latency))
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._items and not self._stopped:
+                    self._cond.wait()
+                if not self._items:
+                    # stopped
+                    return
+                service, success, latency = self._items.popleft()
+            try:
+                self.status._write_status(service, success, latency)
+                self.written += 1
+            except Exception:
+                self.failed += 1
+                log.exception('could not update the status of %s', service)
+
+    def start(self):
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='sstatus-queue')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops the thread once the queue is drained."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        return {'queued': len(self._items), 'dropped': self.dropped,
+                'written': self.written, 'failed': self.failed}
+
+
+class HistoryRecorder(object):
+    """Appends a snapshot of the services to their history every
+    `interval` seconds.
+
+    Only one process of the cluster records a given period (see
+    ServicesStatus.claim).
+    """
+    def __init__(self, status, services, interval=60.):
+        self.status = status
+        self.services = services
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def tick(self, now=None):
+        if now is None:
+            now = time.time()
+        try:
+            if not self.status.claim('history', self.interval, now):
+                # another process got it
+                return False
+            self.status.record_history(self.services, now)
+        except (StatusReadError, StatusWriteError):
+            log.warn('could not record the services history')
+            return False
+        return True
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self.tick()
+            self._stopped.wait(self.interval)
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='sstatus-history')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
 
 
 class ServicesStatus(object):
 
-    def __init__(self, services, servers=None, ttl=600):
+    def __init__(self, services, servers=None, ttl=600, flush_interval=None,
+                 flush_events=100, bucket_size=None, buckets=60,
+                 packed=False, cas_retries=10, pool_size=None,
+                 mmap_path=None, queue_size=None, cache_max_errors=3,
+                 cache_backoff=1., cache_max_backoff=30., history_size=None,
+                 history_interval=60., init_missing=True):
+        if packed and bucket_size:
+            raise ValueError('the packed layout has no sliding window')
+        if flush_interval and queue_size:
+            raise ValueError('choose between write-behind and async updates')
         self.ttl = ttl
+        # packed mode: the status of a service is a single record updated
+        # with gets/cas, and the counters are reset every `ttl` seconds
+        self.packed = packed
+        self.cas_retries = cas_retries
+        # sliding window mode: the counters are kept in a ring of
+        # `buckets` buckets of `bucket_size` seconds
+        self.bucket_size = bucket_size
+        self.buckets = buckets
         if servers is None:
             servers = ['127.0.0.1:11211']
-        self._cache = ServicesStatusCache(servers, services, ttl, binary=True)
+        if pool_size is None and (flush_interval or queue_size or
+                                  (history_size and history_interval)):
+            # pylibmc clients are not thread-safe
+            pool_size = BACKGROUND_POOL_SIZE
+        self._cache = ServicesStatusCache(servers, services, ttl, binary=True,
+                                          packed=packed, pool_size=pool_size,
+                                          mmap_path=mmap_path,
+                                          max_errors=cache_max_errors,
+                                          backoff=cache_backoff,
+                                          max_backoff=cache_max_backoff,
+                                          init_missing=init_missing)
+        if flush_interval:
+            # write-behind mode
+            self._aggregator = StatusAggregator(self, flush_interval,
+                                                flush_events)
+            self._aggregator.start()
+        else:
+            self._aggregator = None
+        if queue_size:
+            # async mode
+            self._queue = StatusQueue(self, queue_size)
+            self._queue.start()
+        else:
+            self._queue = None
+        # history ring of `history_size` snapshots per service, recorded
+        # unless history_interval is None (read-only clients)
+        self.history_size = history_size
+        if history_size and history_interval:
+            self._recorder = HistoryRecorder(self, services, history_interval)
+            self._recorder.start()
+        else:
+            self._recorder = None
 
     def initialize(self, service):
         self._cache.initialize(service)
+        keys = self._latency_keys(service)
+        keys.append(_key('service', service, 'rejects'))
+        if self.bucket_size:
+            for start, succ_key, fail_key in self._bucket_keys(service):
+                keys.extend([succ_key, fail_key])
+        try:
+            self._cache.delete_multi(keys)
+        except WriteError:
+            raise StatusWriteError()
+
+    def _bucket_keys(self, service, now=None, count=None):
+        """Returns the (start, succ key, fail key) of the last `count`
+        buckets of the window, from the oldest to the current one."""
+        if now is None:
+            now = time.time()
+        if count is None:
+            count = self.buckets
+        current = int(now // self.bucket_size)
+        keys = []
+        for bucket in range(current - count + 1, current + 1):
+            keys.append((bucket * self.bucket_size,
+                         _key('service', service, 'succ', str(bucket)),
+                         _key('service', service, 'fail', str(bucket))))
+        return keys
+
+    def _update_record(self, service, enabled=None, successes=0,
+                       failures=0):
+        """Updates the record of a service using gets/cas.
+
+        Returns the new enabled, successes, failures values.
+        """
+        key = _key('service', service)
+        try:
+            for i in range(self.cas_retries):
+                data, cas_id = self._cache.gets(key)
+                now = time.time()
+                if data is None:
+                    on, succ, fail, start = True, 0, 0, now
+                else:
+                    on, succ, fail, start = _unpack_status(data)
+                    if now - start >= self.ttl:
+                        # the window expired
+                        succ, fail, start = 0, 0, now
+
+                if enabled is not None:
+                    on = enabled
+                succ += successes
+                fail += failures
+                record = _pack_status(on, succ, fail, start)
+                if data is None:
+                    if self._cache.add(key, record):
+                        return on, succ, fail
+                elif self._cache.cas(key, record, cas_id):
+                    return on, succ, fail
+        except (WriteError, SomeErrors):
+            raise StatusWriteError()
+        # too much contention
+        raise StatusWriteError()
 
     def enable(self, service):
+        if self.packed:
+            self._update_record(service, enabled=True)
+            return
         try:
             self._cache.set(_key('service', service, 'on'), True)
         except WriteError:
             raise StatusWriteError()
 
     def disable(self, service):
+        if self.packed:
+            self._update_record(service, enabled=False)
+            return
         try:
             self._cache.set(_key('service', service, 'on'), False)
         except WriteError:
             raise StatusWriteError()
 
     def get_status(self, service):
-        try:
-            enabled = self._cache.get(_key('service', service, 'on'))
-            succ = self._cache.get(_key('service', service, 'succ'))
-            if succ is None:
-                succ = 0
+        return self.get_statuses([service])[service]
 
-            fail = self._cache.get(_key('service', service, 'fail'))
-            if fail is None:
-                fail = 0
-
-            return enabled, succ, fail
+    def _get_multi(self, keys):
+        try:
+            return self._cache.get_multi(keys)
         except SomeErrors:
             # could not read the status
             raise StatusReadError()
 
-    def update_status(self, service, success):
+    def _status_keys(self, service, now):
+        """Returns the keys that hold the status of a service."""
+        if self.packed:
+            return [_key('service', service)]
+        keys = [_key('service', service, 'on')]
+        if self.bucket_size:
+            for start, succ_key, fail_key in self._bucket_keys(service, now):
+                keys.extend([succ_key, fail_key])
+        else:
+            keys.extend([_key('service', service, 'succ'),
+                         _key('service', service, 'fail')])
+        return keys
+
+    def _parse_status(self, service, values, now):
+        if self.packed:
+            key = _key('service', service)
+            if key not in values:
+                return self._lost(service), 0, 0
+            enabled, succ, fail, start = _unpack_status(values[key])
+            if now - start >= self.ttl:
+                succ = fail = 0
+            return enabled, succ, fail
+
+        if self.bucket_size:
+            enabled, buckets = self._parse_buckets(service, values, now)
+            succ = sum([bucket[1] for bucket in buckets])
+            fail = sum([bucket[2] for bucket in buckets])
+            return enabled, succ, fail
+
+        enabled = values.get(_key('service', service, 'on'))
+        if enabled is None:
+            enabled = self._lost(service)
+        succ = values.get(_key('service', service, 'succ'), 0)
+        fail = values.get(_key('service', service, 'fail'), 0)
+        return enabled, succ, fail
+
+    def _lost(self, service):
+        # nobody disabled the service, the cache lost its keys
+        self._cache.lost(service)
+        return True
+
+    def _parse_buckets(self, service, values, now):
+        enabled = values.get(_key('service', service, 'on'))
+        if enabled is None:
+            enabled = self._lost(service)
+        buckets = [(start, values.get(succ_key, 0), values.get(fail_key, 0))
+                   for start, succ_key, fail_key
+                   in self._bucket_keys(service, now)]
+        return enabled, buckets
+
+    def _latency_keys(self, service):
+        return [_key('service', service, 'lat', str(index))
+                for index in range(len(LATENCY_BINS) + 1)]
+
+    def _parse_latencies(self, service, values):
+        return [values.get(key, 0) for key in self._latency_keys(service)]
+
+    def get_statuses(self, services):
+        """Returns the status of several services using a single call.
+
+        The result is a mapping of service -> (enabled, succ, fail)
+        """
+        now = time.time()
+        keys = []
+        for service in services:
+            keys.extend(self._status_keys(service, now))
+        values = self._get_multi(keys)
+        return dict([(service, self._parse_status(service, values, now))
+                     for service in services])
+
+    def get_buckets(self, services):
+        """Returns the sliding window of several services using a single call.
+
+        The result is a mapping of service -> (enabled, buckets) where
+        buckets is a list of (start, succ, fail), from the oldest to the
+        current bucket.
+        """
+        if not self.bucket_size:
+            raise ValueError('the sliding window needs a bucket_size')
+
+        now = time.time()
+        keys = []
+        for service in services:
+            keys.extend(self._status_keys(service, now))
+        values = self._get_multi(keys)
+        return dict([(service, self._parse_buckets(service, values, now))
+                     for service in services])
+
+    def get_latencies(self, services):
+        """Returns the latency histograms of several services.
+
+        The result is a mapping of service -> list of counts, one per
+        LATENCY_BINS bin plus one for the slower calls.
+        """
+        keys = []
+        for service in services:
+            keys.extend(self._latency_keys(service))
+        values = self._get_multi(keys)
+        return dict([(service, self._parse_latencies(service, values))
+                     for service in services])
+
+    def get_health(self, services, buckets=False):
+        """Returns the status and the latency histogram of several services
+        using a single call.
+
+        The result is a mapping of service -> (status, histogram) where
+        status is what get_statuses, or get_buckets when `buckets` is
+        True, returns for the service.
+        """
+        if buckets and not self.bucket_size:
+            raise ValueError('the sliding window needs a bucket_size')
+
+        now = time.time()
+        keys = []
+        for service in services:
+            keys.extend(self._status_keys(service, now))
+            keys.extend(self._latency_keys(service))
+        values = self._get_multi(keys)
+
+        if buckets:
+            parse = self._parse_buckets
+        else:
+            parse = self._parse_status
+        return dict([(service, (parse(service, values, now),
+                                self._parse_latencies(service, values)))
+                     for service in services])
+
+    def update_status(self, service, success, latency=None):
+        """Counts a success or a failure, and the latency of the call in
+        seconds when provided."""
+        if self._aggregator is not None:
+            # the write is deferred
+            self._aggregator.add(service, success, latency)
+            return None
+
+        if self._queue is not None:
+            # fire and forget
+            self._queue.put(service, success, latency)
+            return None
+
+        return self._write_status(service, success, latency)
+
+    def _write_status(self, service, success, latency=None):
+        if latency is not None:
+            self.update_latencies(service, {latency_bin(latency): 1})
+
+        if self.packed:
+            if success:
+                return self._update_record(service, successes=1)[1]
+            return self._update_record(service, failures=1)[2]
+
+        if self.bucket_size:
+            if success:
+                return self.update_counts(service, successes=1)
+            return self.update_counts(service, failures=1)
+
         if success:
             key = _key('service', service, 'succ')
-            other_key = _key('service', service, 'fail')
         else:
             key = _key('service', service, 'fail')
-            other_key = _key('service', service, 'succ')
 
+        # the other key is left alone, see update_counts
         try:
-            return self._cache.incr(key)
+            return self._incr_bucket(key, 1)
+        except (WriteError, NotFound):
+            raise StatusWriteError()
+
+    def _window(self):
+        if self.bucket_size:
+            return self.bucket_size * self.buckets
+        return self.ttl
+
+    def _incr_bucket(self, key, delta):
+        try:
+            return self._cache.incr(key, delta)
         except NotFound:
-            # the key ttl-ed
-            self._cache.set(key, 1, time=self.ttl)
-            self._cache.set(other_key, 0, time=self.ttl)
-            return 1
+            # first hit in this bucket
+            if self._cache.add(key, delta, time=self._window()):
+                return delta
+            # another client created it in the meantime
+            return self._cache.incr(key, delta)
+
+    def update_latencies(self, service, bins):
+        """Adds counts to the latency histogram of a service.
+
+        bins is a mapping of bin index -> count, see latency_bin. The
+        histogram is reset with the counters window.
+        """
+        keys = self._latency_keys(service)
+        try:
+            for index, count in bins.items():
+                self._incr_bucket(keys[index], count)
+        except (WriteError, NotFound):
+            raise StatusWriteError()
+
+    def update_counts(self, service, successes=0, failures=0):
+        """Adds several successes and failures to the counters at once."""
+        if self.packed:
+            self._update_record(service, successes=successes,
+                                failures=failures)
+            return
+
+        if self.bucket_size:
+            start, succ_key, fail_key = self._bucket_keys(service, count=1)[0]
+            try:
+                if successes:
+                    self._incr_bucket(succ_key, successes)
+                if failures:
+                    self._incr_bucket(fail_key, failures)
+            except (WriteError, NotFound):
+                raise StatusWriteError()
+            return
+
+        # each key may have ttl-ed on its own, only the missing one is
+        # created so the other keeps its count
+        try:
+            if successes:
+                self._incr_bucket(_key('service', service, 'succ'),
+                                  successes)
+            if failures:
+                self._incr_bucket(_key('service', service, 'fail'),
+                                  failures)
+        except (WriteError, NotFound):
+            raise StatusWriteError()
+
+    def flush(self):
+        """Writes the pending updates, when in write-behind mode."""
+        if self._aggregator is not None:
+            return self._aggregator.flush()
+        return True
+
+    def lease_tokens(self, service, rate, capacity, count):
+        """Takes up to `count` tokens from the token bucket of a service.
+
+        The bucket is shared by all the clients of the cache. It holds up
+        to `capacity` tokens and is refilled with `rate` tokens per second.
+        Returns the number of tokens granted.
+        """
+        key = _key('service', service, 'tokens')
+        for i in range(self.cas_retries):
+            data, cas_id = self._cache.gets(key)
+            now = time.time()
+            if data is None:
+                tokens = capacity
+            else:
+                tokens, last = _TOKENS.unpack(data)
+                tokens = min(capacity, tokens + (now - last) * rate)
+            granted = int(min(count, tokens))
+            record = _TOKENS.pack(tokens - granted, now)
+            if data is None:
+                if self._cache.add(key, record):
+                    return granted
+            elif self._cache.cas(key, record, cas_id):
+                return granted
+        # too much contention
+        raise StatusWriteError()
+
+    def update_stats(self):
+        """Returns the counters of the async updates queue, if any."""
+        if self._queue is None:
+            return None
+        return self._queue.stats()
+
+    def claim(self, name, period, now=None):
+        """Returns True if the caller is the first process of the cluster
+        to claim `name` for the current `period` seconds.
+
+        Used to run periodic tasks once per period across all the
+        processes sharing the cache.
+        """
+        if now is None:
+            now = time.time()
+        key = _key('claim', name, str(int(now // period)))
+        try:
+            return self._cache.add(key, True, time=int(period * 2))
         except WriteError:
             raise StatusWriteError()
 
+    def update_rejects(self, service, count=1):
+        """Counts requests rejected for a service."""
+        try:
+            self._incr_bucket(_key('service', service, 'rejects'), count)
+        except (WriteError, NotFound):
+            raise StatusWriteError()
+
+    def get_rejects(self, services):
+        keys = [_key('service', service, 'rejects') for service in services]
+        values = self._get_multi(keys)
+        return dict([(service, values.get(key, 0))
+                     for service, key in zip(services, keys)])
+
+    def record_history(self, services, now=None):
+        """Appends a snapshot of the current counters of the services to
+        their history ring."""
+        if not self.history_size:
+            raise ValueError('the history needs a history_size')
+        if now is None:
+            now = time.time()
+        health = self.get_health(services)
+        rejects = self.get_rejects(services)
+        # the window sums drop as the buckets leave the window, they are
+        # not counters that can be diffed
+        window = 0
+        if self.bucket_size:
+            window = min(int(math.ceil(self.bucket_size * self.buckets)),
+                         _MAX_WINDOW)
+        for service in services:
+            (enabled, succ, fail), histogram = health[service]
+            latency = latency_percentile(histogram, .95)
+            if latency is None:
+                latency = -1
+            counter = _key('service', service, 'hist')
+            try:
+                self._cache.add(counter, 0)
+                index = self._cache.incr(counter) % self.history_size
+                self._cache.set(_key(counter, str(index)),
+                                _SNAPSHOT.pack(now, succ, fail, latency,
+                                               rejects[service], window))
+            except (WriteError, NotFound):
+                raise StatusWriteError()
+
+    def get_history(self, services):
+        """Returns the history of several services using a single call.
+
+        The result is a mapping of service -> list of (time, succ, fail,
+        p95 latency or -1, rejects, window) from the oldest to the newest.
+        window is the length in seconds of the sliding window the counts
+        are summed over, or 0 for plain counters.
+        """
+        if not self.history_size:
+            raise ValueError('the history needs a history_size')
+        keys = []
+        for service in services:
+            counter = _key('service', service, 'hist')
+            keys.extend([_key(counter, str(index))
+                         for index in range(self.history_size)])
+        values = self._get_multi(keys)
+
+        history = {}
+        for service in services:
+            counter = _key('service', service, 'hist')
+            snapshots = [values.get(_key(counter, str(index)))
+                         for index in range(self.history_size)]
+            # skips the snapshots of another format
+            snapshots = [_SNAPSHOT.unpack(snapshot) for snapshot in snapshots
+                         if snapshot is not None and
+                         len(snapshot) == _SNAPSHOT.size]
+            snapshots.sort()
+            history[service] = snapshots
+        return history
+
+    def close(self):
+        if self._aggregator is not None:
+            self._aggregator.stop()
+        if self._queue is not None:
+            self._queue.stop()
+        if self._recorder is not None:
+            self._recorder.stop()
+
+
+class StatusSnapshot(object):
+    """Process-local copy of the statuses of a list of services.
+
+    A background thread refreshes the copy every `interval` seconds by
+    calling `read` with the list of services. get() returns None when
+    the copy is older than `max_age` seconds, so the caller can fall back
+    to a synchronous read.
+    """
+    def __init__(self, read, services, interval=1., max_age=None):
+        self.read = read
+        self.services = services
+        self.interval = interval
+        if max_age is None:
+            max_age = interval * 3
+        self.max_age = max_age
+        self._statuses = {}
+        self._updated = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def refresh(self):
+        try:
+            statuses = self.read(self.services)
+        except StatusReadError:
+            log.warn('could not refresh the services statuses')
+            return False
+        # rebinding the dict is atomic, readers never see a partial update
+        self._statuses = statuses
+        self._updated = time.time()
+        return True
+
+    def get(self, service):
+        if time.time() - self._updated > self.max_age:
+            return None
+        return self._statuses.get(service)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._stopped.wait(self.interval)
+            if not self._stopped.is_set():
+                self.refresh()
+
+    def start(self):
+        self._stopped.clear()
+        self.refresh()
+        self._thread = threading.Thread(target=self._run,
+                                        name='sstatus-snapshot')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+
+class CircuitBreaker(object):
+    """Per-process circuit breaker fed with the sliding window of a service.
+
+    - closed: requests go through. The breaker opens when the
+      successes/failures ratio gets under the treshold, either on the
+      whole window or on its last `recent` buckets, as soon as there
+      are at least `min_requests` calls to judge.
+    - open: requests are rejected for `open_timeout` seconds, then the
+      breaker becomes half-open.
+    - half-open: up to `probes` requests go through every `open_timeout`
+      seconds. The breaker closes when `probes` successes were seen
+      since it became half-open and opens again on any new failure.
+
+    Once closed again, only the calls made since the breaker closed are
+    judged, the failures of the outage are still in the window.
+    """
+    def __init__(self, treshold, open_timeout=30, probes=1, min_requests=10,
+                 recent=2):
+        self.treshold = treshold
+        self.open_timeout = open_timeout
+        self.probes = probes
+        self.min_requests = min_requests
+        self.recent = recent
+        self._lock = threading.Lock()
+        self._set_state(CLOSED, 0)
+
+    def _tripped(self, buckets):
+        for window in (buckets, buckets[-self.recent:]):
+            succ = sum([bucket[1] for bucket in window])
+            fail = sum([bucket[2] for bucket in window])
+            if fail == 0 or succ + fail < self.min_requests:
+                continue
+            if float(succ) / float(fail) < self.treshold:
+                return True
+        return False
+
+    def _since_change(self, buckets):
+        """Returns the buckets minus the counts seen when the state
+        changed."""
+        res = []
+        for start, succ, fail in buckets:
+            base_succ, base_fail = self._base.get(start, (0, 0))
+            res.append((start, succ - base_succ, fail - base_fail))
+        return res
+
+    def _set_state(self, state, now, buckets=()):
+        self.state = state
+        self._changed = now
+        self._probes_left = self.probes
+        # counters seen when the state changed, per bucket start
+        self._base = dict([(bucket[0], bucket[1:]) for bucket in buckets])
+
+    def allow(self, buckets, now=None):
+        """Returns True if a request can go through.
+
+        buckets is the sliding window of the service, as returned by
+        ServicesStatus.get_buckets
+        """
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            if self.state == CLOSED:
+                if not self._tripped(self._since_change(buckets)):
+                    return True
+                self._set_state(OPEN, now)
+                return False
+
+            if self.state == OPEN:
+                if now - self._changed < self.open_timeout:
+                    return False
+                self._set_state(HALF_OPEN, now, buckets)
+
+            # half-open: look at what happened since the probing started
+            since = self._since_change(buckets)
+            succ = sum([bucket[1] for bucket in since])
+            fail = sum([bucket[2] for bucket in since])
+
+            if fail > 0:
+                self._set_state(OPEN, now)
+                return False
+            if succ >= self.probes:
+                self._set_state(CLOSED, now, buckets)
+                return True
+            if now - self._changed >= self.open_timeout:
+                # the probes did not come back, try again
+                self._set_state(HALF_OPEN, now, buckets)
+            if self._probes_left > 0:
+                self._probes_left -= 1
+                return True
+            return False
+
+    def retry_in(self, now=None):
+        """Returns the number of seconds before the breaker lets probes
+        through, 0 if it is not open."""
+        if self.state != OPEN:
+            return 0
+        if now is None:
+            now = time.time()
+        return max(self.open_timeout - (now - self._changed), 0)
+
+
+class TokenLease(object):
+    """Process-local lease on the shared token bucket of a service.
+
+    Tokens are taken from the bucket `size` at a time, so most requests
+    only decrement a local counter. Leased tokens that were not used
+    within `ttl` seconds are given up.
+    """
+    def __init__(self, checker, service, rate, capacity=None, size=10,
+                 ttl=1.):
+        self.checker = checker
+        self.service = service
+        self.rate = rate
+        if capacity is None:
+            capacity = max(rate, 1)
+        self.capacity = capacity
+        self.size = max(1, min(size, int(capacity)))
+        self.ttl = ttl
+        self._tokens = 0
+        self._expires = self._next_lease = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Returns True if the request can go through."""
+        with self._lock:
+            now = time.time()
+            if now >= self._expires:
+                self._tokens = 0
+            if self._tokens <= 0 and now >= self._next_lease:
+                try:
+                    self._tokens = self.checker.lease_tokens(self.service,
+                                                             self.rate,
+                                                             self.capacity,
+                                                             self.size)
+                except (StatusReadError, StatusWriteError):
+                    # could not reach the bucket
+                    return True
+                self._expires = now + self.ttl
+                if self._tokens <= 0:
+                    # the bucket is empty, no need to ask before a refill
+                    self._next_lease = now + min(self.ttl, 1. / self.rate)
+            if self._tokens <= 0:
+                return False
+            self._tokens -= 1
+            return True
+
 
 class ServicesStatusMiddleware(object):
 
     def __init__(self, app, services, tresholds, retry_after=600,
-                 cache_servers=None):
+                 cache_servers=None, snapshot_interval=None,
+                 snapshot_max_age=None, bucket_size=None, buckets=60,
+                 open_timeout=30, probes=1, min_requests=10, packed=False,
+                 cache_pool_size=None, mmap_path=None,
+                 latency_tresholds=None, latency_percentile=.95,
+                 latency_min_requests=10, min_retry_after=30,
+                 retry_jitter=.2, ramp_duration=None, rate_limits=None,
+                 rate_bursts=None, lease_size=10, history_size=None,
+                 history_interval=60.):
         self.app = app
         self.services = services
         self.tresholds = tresholds
+        # Retry-After goes from min_retry_after to retry_after depending
+        # on the failures, +/- retry_jitter percent
         self.retry_after = retry_after
-        self._status_checker = ServicesStatus(services, cache_servers)
+        self.min_retry_after = min_retry_after
+        self.retry_jitter = retry_jitter
+        # once a service recovers, the share of requests let through
+        # rises from 0 to 100% in ramp_duration seconds
+        self.ramp_duration = ramp_duration
+        self._rejecting = [False] * len(services)
+        self._recovered = [None] * len(services)
+        # rejections are written at most once per second per service
+        self._rejects = [0] * len(services)
+        self._rejects_written = [0] * len(services)
+        # max latency in seconds of each service, None to disable
+        self.latency_tresholds = latency_tresholds
+        self.latency_percentile = latency_percentile
+        self.latency_min_requests = latency_min_requests
+        if cache_pool_size is None and snapshot_interval:
+            # the snapshot is refreshed by a background thread
+            cache_pool_size = BACKGROUND_POOL_SIZE
+        self._status_checker = ServicesStatus(
+            services, cache_servers, bucket_size=bucket_size,
+            buckets=buckets, packed=packed, pool_size=cache_pool_size,
+            mmap_path=mmap_path, history_size=history_size,
+            history_interval=history_interval)
+        if bucket_size:
+            # sliding window circuit breakers
+            self._breakers = [CircuitBreaker(treshold, open_timeout, probes,
+                                             min_requests)
+                              for treshold in tresholds]
+            self._read = self._status_checker.get_buckets
+            self._unknown = True, []
+        else:
+            self._breakers = None
+            self._read = self._status_checker.get_statuses
+            self._unknown = True, 0, 0
 
-    def _503(self, start_response):
+        # requests per second allowed for each service, None for no limit
+        self.rate_limits = rate_limits
+        if rate_limits is not None:
+            if rate_bursts is None:
+                rate_bursts = [None] * len(services)
+            self._leases = [rate and TokenLease(self._status_checker, service,
+                                                rate, burst, lease_size)
+                            for service, rate, burst
+                            in zip(services, rate_limits, rate_bursts)]
+        else:
+            self._leases = None
+
+        if latency_tresholds is not None:
+            # read the latency histograms along with the statuses
+            def _read(services, checker=self._status_checker,
+                      buckets=bool(bucket_size)):
+                return checker.get_health(services, buckets=buckets)
+            self._read = _read
+            self._unknown = self._unknown, None
+
+        if snapshot_interval:
+            self._snapshot = StatusSnapshot(self._read, services,
+                                            snapshot_interval,
+                                            snapshot_max_age)
+            self._snapshot.start()
+        else:
+            self._snapshot = None
+
+    def _get_status(self, service):
+        if self._snapshot is not None:
+            status = self._snapshot.get(service)
+            if status is not None:
+                return status
+        try:
+            return self._read([service])[service]
+        except StatusReadError:
+            # could not read the status
+            return self._unknown
+
+    def _503(self, start_response, retry_after=None):
+        if retry_after is None:
+            retry_after = self.retry_after
         headers = [('Content-Type', 'text/plain'),
-                   ('Retry-After', str(self.retry_after))]
+                   ('Retry-After', str(retry_after))]
 
         start_response('503 Service Unavailable', headers)
         return ['The service is unavailable']
 
+    def _jitter(self, delay):
+        if self.retry_jitter:
+            delay *= 1 + random.uniform(-self.retry_jitter, self.retry_jitter)
+        return max(int(delay), 1)
+
+    def _retry_after(self, severity=1.):
+        """Computes a Retry-After for a severity between 0 and 1"""
+        delay = self.min_retry_after
+        delay += (self.retry_after - self.min_retry_after) * severity
+        return self._jitter(delay)
+
+    def _count_reject(self, index):
+        self._rejects[index] += 1
+        now = time.time()
+        if now - self._rejects_written[index] < 1:
+            return
+        count, self._rejects[index] = self._rejects[index], 0
+        self._rejects_written[index] = now
+        try:
+            self._status_checker.update_rejects(self.services[index], count)
+        except StatusWriteError:
+            pass
+
+    def _reject(self, index, start_response, retry_after=None):
+        self._rejecting[index] = True
+        self._count_reject(index)
+        return self._503(start_response, retry_after)
+
+    def _admit(self, index):
+        """Lets a rising share of the requests through after a recovery"""
+        if not self.ramp_duration:
+            return True
+        now = time.time()
+        if self._rejecting[index]:
+            self._rejecting[index] = False
+            self._recovered[index] = now
+        recovered = self._recovered[index]
+        if recovered is None:
+            return True
+        elapsed = now - recovered
+        if elapsed >= self.ramp_duration:
+            self._recovered[index] = None
+            return True
+        return random.random() < elapsed / self.ramp_duration
+
     def __call__(self, environ, start_response):
         target_service = environ.get('HTTP_X_TARGET_DOMAIN')
         try:
@@ -195,33 +1526,196 @@ class ServicesStatusMiddleware(object):
         except ValueError:
             index = -1
 
-        if index != -1:
-            try:
-                on, succ, fail = \
-                    self._status_checker.get_status(target_service)
-            except StatusReadError:
-                # could not read the status
-                on, succ, fail = True, 0, 0
+        if index == -1:
+            return self.app(environ, start_response)
+
+        status = self._get_status(target_service)
+        if self.latency_tresholds is not None:
+            status, histogram = status
+        else:
+            histogram = None
 
+        if self._breakers is not None:
+            on, buckets = status
             if not on:
-                return self._503(start_response)
+                # disabled by hand
+                return self._reject(index, start_response)
+            breaker = self._breakers[index]
+            if not breaker.allow(buckets):
+                retry_after = self._jitter(max(breaker.retry_in(), 1))
+                return self._reject(index, start_response, retry_after)
+        else:
+            on, succ, fail = status
+
+            if not on:
+                # disabled by hand
+                return self._reject(index, start_response)
 
             if fail != 0:
                 ratio = float(succ) / float(fail)
                 if ratio < self.tresholds[index]:
-                    return self._503(start_response)
+                    severity = float(fail) / float(succ + fail)
+                    return self._reject(index, start_response,
+                                        self._retry_after(severity))
+
+        if self._too_slow(index, histogram):
+            return self._reject(index, start_response, self._retry_after())
+
+        if not self._admit(index):
+            self._count_reject(index)
+            return self._503(start_response,
+                             self._jitter(self.min_retry_after))
+
+        if self._leases is not None and self._leases[index]:
+            lease = self._leases[index]
+            if not lease.acquire():
+                self._count_reject(index)
+                return self._503(start_response,
+                                 max(int(1. / lease.rate), 1))
 
         return self.app(environ, start_response)
 
+    def _too_slow(self, index, histogram):
+        if histogram is None or sum(histogram) < self.latency_min_requests:
+            return False
+        treshold = self.latency_tresholds[index]
+        if treshold is None:
+            return False
+        latency = latency_percentile(histogram, self.latency_percentile)
+        return latency is not None and latency > treshold
+
+
+def _fleet_statuses(connect, servers, services, timeout=1., buckets=False):
+    """Reads the statuses of the services on several servers concurrently.
+
+    connect is called with a server in the reader thread of the server and
+    returns a new ServicesStatus, so a reader that is still blocked after
+    the timeout does not share its client. The result is a mapping of
+    server -> statuses, or None for the servers that could not be read
+    within `timeout` seconds. The statuses are what get_statuses returns,
+    or get_buckets when `buckets` is True.
+    """
+    results = dict([(server, None) for server in servers])
+
+    def _read(server):
+        try:
+            checker = connect(server)
+            if buckets:
+                results[server] = checker.get_buckets(services)
+            else:
+                results[server] = checker.get_statuses(services)
+        except StatusReadError:
+            pass
+
+    threads = []
+    for server in servers:
+        thread = threading.Thread(target=_read, args=(server,),
+                                  name='sstatus-read')
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    deadline = time.time() + timeout
+    for thread in threads:
+        thread.join(max(deadline - time.time(), 0))
+    # the late threads may still write in results
+    return dict(results)
+
+
+def _fleet_total(statuses, services):
+    """Sums the statuses of the servers that answered.
+
+    A service is enabled if it is enabled on all of them, and its state is
+    None if no server answered.
+    """
+    total = {}
+    for service in services:
+        enabled, succ, fail = None, 0, 0
+        for server_statuses in statuses.values():
+            if server_statuses is None:
+                continue
+            server_enabled, server_succ, server_fail = \
+                server_statuses[service]
+            enabled = enabled is not False and server_enabled
+            succ += server_succ
+            fail += server_fail
+        total[service] = enabled, succ, fail
+    return total
+
+
+def _delta(old, new):
+    # the counters are reset every `ttl` seconds
+    if new < old:
+        return new
+    return new - old
+
+
+def _counted(old, new):
+    """Returns the successes and failures counted between two reads of a
+    status, (enabled, succ, fail) or (enabled, buckets)."""
+    if len(new) == 2:
+        # the window sums drop when a bucket expires, the buckets are
+        # compared one by one instead
+        old = dict([(start, (succ, fail)) for start, succ, fail in old[1]])
+        succ = fail = 0
+        for start, new_succ, new_fail in new[1]:
+            old_succ, old_fail = old.get(start, (0, 0))
+            succ += _delta(old_succ, new_succ)
+            fail += _delta(old_fail, new_fail)
+        return succ, fail
+    return _delta(old[1], new[1]), _delta(old[2], new[2])
+
+
+def _fleet_rates(previous, current, services, elapsed):
+    """Returns a mapping of service -> (enabled, successes per second,
+    failures per second) between two _fleet_statuses results."""
+    rates = {}
+    for service in services:
+        enabled, succ, fail = None, 0, 0
+        for server, server_statuses in current.items():
+            if server_statuses is None:
+                continue
+            server_enabled = server_statuses[service][0]
+            enabled = enabled is not False and server_enabled
+            if previous.get(server) is None:
+                continue
+            new_succ, new_fail = _counted(previous[server][service],
+                                          server_statuses[service])
+            succ += new_succ
+            fail += new_fail
+        rates[service] = enabled, succ / elapsed, fail / elapsed
+    return rates
+
+
+def _status_dict(status):
+    enabled, succ, fail = status
+    return {'enabled': enabled, 'successes': succ, 'failures': fail}
+
 
 _USAGE = """\
-Usage : sstatus server domain action [options]
+Usage : sstatus server[,server...] domain[,domain...] action [options]
 
 Available actions:
-    - status: returns a status for the domain
+    - status [--json]: returns a status for the domain(s) on the server(s),
+      and their total when there are several servers
+    - watch [interval] [--json]: prints the successes and failures per
+      second of the domain(s) on the server(s) every `interval` seconds
+      (1 by default) until interrupted
     - enable: enable the domain
     - disable: disable the domain
     - reset: reset the domain by setting the counters to 0 and enabling it
+    - history [size]: trends of the domain(s) over the last `size`
+      snapshots (60 by default), needs NumPy
+
+The servers are read concurrently, a server that does not answer within a
+second is reported as unreachable. With --json, status prints a single
+JSON object and watch prints one JSON object per line.
+
+The statuses are read and written in the layout of the servers: add
+--packed when they use the packed layout (ServicesStatus(packed=True)),
+or --bucket-size seconds [--buckets count] when they use a sliding window
+(ServicesStatus(bucket_size=...)), the counts are then summed over the
+window.
 
 Example:
 
@@ -229,8 +1723,42 @@ Example:
     This service is enabled.
     12653 successes, 3 failures.
 
+    $ sstatus 127.0.0.1:11211 google.com,twitter.com status
+    google.com: enabled, 12653 successes, 3 failures.
+    twitter.com: disabled.
+
+    $ sstatus 10.0.0.1,10.0.0.2 google.com,twitter.com status
+    10.0.0.1 google.com: enabled, 8653 successes, 2 failures.
+    10.0.0.1 twitter.com: disabled.
+    10.0.0.2: unreachable.
+    total google.com: enabled, 8653 successes, 2 failures.
+    total twitter.com: disabled.
+
+    $ sstatus 10.0.0.1,10.0.0.2 google.com watch
+    10:01:00 google.com: enabled, 12.0 successes/s, 0.0 failures/s.
+    10:01:01 google.com: enabled, 11.0 successes/s, 1.0 failures/s.
+
+    $ sstatus 127.0.0.1:11211 google.com history
+    google.com:
+      2011-03-02 10:01:00  12.3 req/s  0.2% failures (avg 0.3%)  p95 0.25s
+      2011-03-02 10:02:00  11.9 req/s  8.5% failures (avg 2.8%)  p95 1.00s !
+
 """
 
+
+def _pop_option(args, name, default=None):
+    """Removes `name value` from args and returns the value."""
+    if name not in args:
+        return default
+    index = args.index(name)
+    value = args[index + 1:index + 2]
+    del args[index:index + 2]
+    if not value:
+        print('%s needs a value.' % name)
+        sys.exit(1)
+    return value[0]
+
+
 def _ask(question):
     answer = raw_input(question + ' ')
     answer = answer.lower().strip()
@@ -242,24 +1770,173 @@ if __name__ == '__main__':
         print(_USAGE)
         sys.exit(1)
 
-    server = sys.argv[1]
-    domain = sys.argv[2]
+    servers = sys.argv[1].split(',')
+    server = servers[0]
+    domains = sys.argv[2].split(',')
+    domain = domains[0]
     action = sys.argv[3]
-    options = sys.argv[4:]
+    args = sys.argv[4:]
+    bucket_size = _pop_option(args, '--bucket-size')
+    if bucket_size is not None:
+        bucket_size = float(bucket_size)
+    buckets = int(_pop_option(args, '--buckets', 60))
+    options = [option for option in args
+               if option not in ('--json', '--packed')]
+    as_json = '--json' in args
+    packed = '--packed' in args
+
+    if packed and bucket_size:
+        print('The packed layout has no sliding window.')
+        sys.exit(1)
 
-    server = ServicesStatus([domain], [server])
+    if action not in ('status', 'watch', 'history') and len(domains) > 1:
+        print('Only the status, watch and history actions accept several '
+              'domains.')
+        sys.exit(1)
+
+    if action not in ('status', 'watch') and len(servers) > 1:
+        print('Only the status and watch actions accept several servers.')
+        sys.exit(1)
+
+    def _connect(address, **options):
+        # the reads do not add the missing statuses
+        if action in ('status', 'watch', 'history'):
+            options['init_missing'] = False
+        return ServicesStatus(domains, [address], packed=packed,
+                              bucket_size=bucket_size, buckets=buckets,
+                              **options)
+
+    if action in ('status', 'watch'):
+        import json
+
+    if action == 'status' and (as_json or len(servers) > 1):
+        statuses = _fleet_statuses(_connect, servers, domains)
+        total = _fleet_total(statuses, domains)
+        if as_json:
+            result = {'servers': {}, 'total': {}}
+            for server, server_statuses in statuses.items():
+                if server_statuses is not None:
+                    server_statuses = dict(
+                        [(name, _status_dict(server_statuses[name]))
+                         for name in domains])
+                result['servers'][server] = server_statuses
+            for domain in domains:
+                result['total'][domain] = _status_dict(total[domain])
+            print(json.dumps(result))
+        else:
+            for server in servers:
+                if statuses[server] is None:
+                    print('%s: unreachable.' % server)
+                    continue
+                for domain in domains:
+                    enabled, success, fail = statuses[server][domain]
+                    if not enabled:
+                        print('%s %s: disabled.' % (server, domain))
+                    else:
+                        print('%s %s: enabled, %d successes, %d failures.' %
+                              (server, domain, success, fail))
+            for domain in domains:
+                enabled, success, fail = total[domain]
+                if enabled is None:
+                    print('total %s: unknown.' % domain)
+                elif not enabled:
+                    print('total %s: disabled.' % domain)
+                else:
+                    print('total %s: enabled, %d successes, %d failures.' %
+                          (domain, success, fail))
+        # the exit status tells if all the servers could be read
+        sys.exit(None in statuses.values() and 1 or 0)
+
+    if action == 'watch':
+        interval = options and float(options[0]) or 1.
+        previous = _fleet_statuses(_connect, servers, domains,
+                                   buckets=bool(bucket_size))
+        last = time.time()
+        try:
+            while True:
+                time.sleep(max(last + interval - time.time(), 0))
+                current = _fleet_statuses(_connect, servers, domains,
+                                          buckets=bool(bucket_size))
+                now = time.time()
+                rates = _fleet_rates(previous, current, domains, now - last)
+                down = sorted([address for address, read
+                               in current.items() if read is None])
+                previous, last = current, now
+                if as_json:
+                    rates = dict([(name, _status_dict(rates[name]))
+                                  for name in domains])
+                    print(json.dumps({'time': now, 'unreachable': down,
+                                      'rates': rates}))
+                    sys.stdout.flush()
+                    continue
+                when = time.strftime('%H:%M:%S', time.localtime(now))
+                for server in down:
+                    print('%s %s: unreachable.' % (when, server))
+                for domain in domains:
+                    enabled, success, fail = rates[domain]
+                    if enabled is None:
+                        continue
+                    print('%s %s: %s, %.1f successes/s, %.1f failures/s.' %
+                          (when, domain, enabled and 'enabled' or 'disabled',
+                           success, fail))
+                sys.stdout.flush()
+        except KeyboardInterrupt:
+            sys.exit(0)
+
+    if action == 'history':
+        from math import isnan
+        from linkoauth.trends import analyze
+        size = options and int(options[0]) or 60
+        server = _connect(server, history_size=size, history_interval=None)
+        try:
+            trends = analyze(server.get_history(domains))
+        except StatusReadError:
+            print('Ooops, could not read the history.')
+            sys.exit(1)
+
+        for domain in domains:
+            print('%s:' % domain)
+            trend = trends[domain]
+            for index, when in enumerate(trend['times']):
+                rate = trend['succ_rate'][index] + trend['fail_rate'][index]
+                line = '  %s  %.1f req/s' % (time.strftime(
+                    '%Y-%m-%d %H:%M:%S', time.localtime(when)), rate)
+                if not isnan(trend['ratio'][index]):
+                    line += '  %.1f%% failures (avg %.1f%%)' % (
+                        trend['ratio'][index] * 100,
+                        trend['ewma'][index] * 100)
+                if not isnan(trend['latency'][index]):
+                    line += '  p95 %.2fs' % trend['latency'][index]
+                if trend['rejects'][index]:
+                    line += '  %d rejects' % trend['rejects'][index]
+                if trend['anomaly'][index]:
+                    line += ' !'
+                print(line)
+        sys.exit(0)
+
+    server = _connect(server)
     if action == 'status':
         try:
-            enabled, success, fail = server.get_status(domain)
+            statuses = server.get_statuses(domains)
         except StatusReadError:
             print('Ooops, could not read the status.')
             sys.exit(1)
 
-        if not enabled:
-            print('This service has been disabled')
+        if len(domains) == 1:
+            enabled, success, fail = statuses[domain]
+            if not enabled:
+                print('This service has been disabled')
+            else:
+                print('This service is enabled.')
+                print('%d successes, %d failures.' % (success, fail))
         else:
-            print('This service is enabled.')
-            print('%d successes, %d failures.' % (success, fail))
+            for domain in domains:
+                enabled, success, fail = statuses[domain]
+                if not enabled:
+                    print('%s: disabled.' % domain)
+                else:
+                    print('%s: enabled, %d successes, %d failures.' %
+                          (domain, success, fail))
         sys.exit(0)
     elif action == 'enable':
         try:
@@ -296,5 +1973,5 @@ if __name__ == '__main__':
         sys.exit(0)
     else:
         print('Unknown action.')
-        print(usage)
+        print(_USAGE)
         sys.exit(1)
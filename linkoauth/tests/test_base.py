@@ -3,13 +3,17 @@ import httplib2
 import json
 import mock
 import time
+import threading
 import urllib2
 
+from _pylibmc import NotFound
+
 from linkoauth.util import setup_config
 from linkoauth.backends import google_
 from linkoauth import Services
 from linkoauth import sstatus
 from linkoauth.errors import DomainNotRegisteredError
+from linkoauth.util import time_left
 
 
 _ACCOUNT = {'oauth_token': 'xxx',
@@ -69,6 +73,10 @@ class MockCache(object):
     def __init__(self):
         self._cache = dict()
         self._cache_ttl = dict()
+        self._cas_ids = dict()
+
+    def clone(self):
+        return self
 
     def get(self, key):
         if key in self._cache_ttl:
@@ -81,14 +89,54 @@ class MockCache(object):
                 self._cache_ttl[key] = (ttl, now)
         return self._cache.get(key)
 
+    def get_multi(self, keys):
+        res = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                res[key] = value
+        return res
+
+    def gets(self, key):
+        value = self.get(key)
+        if value is None:
+            return None, None
+        return value, self._cas_ids.get(key, 0)
+
+    def cas(self, key, value, cas_id, **kwargs):
+        if self.gets(key)[1] != cas_id:
+            return False
+        self.set(key, value, **kwargs)
+        return True
+
     def set(self, key, value, **kwargs):
         self._cache[key] = value
+        self._cas_ids[key] = self._cas_ids.get(key, 0) + 1
         ttl = kwargs.get('time')
         if ttl is not None:
             self._cache_ttl[key] = (ttl, time.time())
 
-    def incr(self, key):
-        self._cache[key] = self._cache[key] + 1
+    def add(self, key, value, **kwargs):
+        if self.get(key) is not None:
+            return False
+        self.set(key, value, **kwargs)
+        return True
+
+    def add_multi(self, mapping, **kwargs):
+        return [key for key, value in mapping.items()
+                if not self.add(key, value, **kwargs)]
+
+    def incr(self, key, delta=1):
+        if self.get(key) is None:
+            raise NotFound(key)
+        self._cache[key] = self._cache[key] + delta
+        return self._cache[key]
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self._cache.pop(key, None)
+            self._cache_ttl.pop(key, None)
+        return True
 
 
 class TestBasics(unittest.TestCase):
@@ -157,3 +205,273 @@ class TestBasics(unittest.TestCase):
 
         status = services.get_status('google.com')
         self.assertEquals(status, (True, 0, 0))
+
+    def test_responders_reused(self):
+        services = Services(['google.com', 'yahoo.com'])
+        google = services._get_responder('google.com')
+        self.assertTrue(services._get_responder('google.com') is google)
+        self.assertFalse(services._get_responder('yahoo.com') is google)
+
+        # the OpenID store outlives the responders
+        self.assertTrue(google_.GoogleResponder().openid_store is
+                        google.openid_store)
+
+        # a new configuration gets new responders
+        setup_config(dict(_CONFIG))
+        self.assertFalse(services._get_responder('google.com') is google)
+
+    def test_sendmessage_many(self):
+        args = {'to': 'tarek@ziade.org',
+                'subject': 'xxx',
+                'title': 'the title',
+                'description': 'some description',
+                'link': 'http://example.com',
+                'shorturl': 'http://example.com'}
+
+        services = Services(['google.com'], send_pool_size=3)
+        services.initialize('google.com')
+        items = [(_ACCOUNT, 'message %d' % i, args) for i in range(3)]
+        results = services.sendmessage_many('google.com', items)
+        self.assertEqual(len(results), 3)
+        for res, error in results:
+            self.assertEqual(error, None)
+        self.assertEquals(services.get_status('google.com'), (True, 3, 0))
+
+        # the sends run concurrently
+        def _sendmessage(domain, account, message, options, headers):
+            if message == 'boom':
+                raise ValueError('boom')
+            time.sleep(.2)
+            return {'message': message}, None
+
+        services.sendmessage = _sendmessage
+        items = [(_ACCOUNT, 'message %d' % i, args) for i in range(3)]
+        items.append((_ACCOUNT, 'boom', args))
+        start = time.time()
+        results = services.sendmessage_many('google.com', items)
+        self.assertTrue(time.time() - start < .5)
+        self.assertEqual(results[1], ({'message': 'message 1'}, None))
+        self.assertEqual(results[3][1]['message'], 'boom')
+
+        # the items that are not done in time get an error
+        items = [(_ACCOUNT, 'message %d' % i, args) for i in range(6)]
+        results = services.sendmessage_many('google.com', items, timeout=.1)
+        self.assertEqual([error['code'] for res, error in results],
+                         [504] * 6)
+
+        # the requesters write in the headers, they are not shared
+        def _sendmessage(domain, account, message, options, headers):
+            headers['Authorization'] = message
+            time.sleep(.1)
+            return {'message': headers['Authorization']}, None
+
+        services.sendmessage = _sendmessage
+        headers = {'Accept': 'application/json'}
+        items = [(_ACCOUNT, 'message %d' % i, args) for i in range(3)]
+        results = services.sendmessage_many('google.com', items, headers)
+        self.assertEqual([res['message'] for res, error in results],
+                         ['message 0', 'message 1', 'message 2'])
+        self.assertEqual(headers, {'Accept': 'application/json'})
+        services.close()
+
+    def test_share(self):
+        services = Services(['google.com', 'twitter.com', 'yahoo.com'],
+                            send_pool_size=3)
+        delays = {'google.com': .1, 'twitter.com': 0, 'yahoo.com': 1}
+
+        def _sendmessage(domain, account, message, options, headers):
+            time.sleep(delays[domain])
+            return {'domain': domain}, None
+
+        services.sendmessage = _sendmessage
+        targets = [(domain, _ACCOUNT, 'message', {})
+                   for domain in ('google.com', 'twitter.com', 'yahoo.com')]
+        start = time.time()
+        results = list(services.iter_share(targets, timeout=.5))
+        self.assertTrue(time.time() - start < .8)
+
+        # as they complete, and the ones out of time last
+        self.assertEqual([domain for domain, res in results],
+                         ['twitter.com', 'google.com', 'yahoo.com'])
+        self.assertEqual(results[0][1], ({'domain': 'twitter.com'}, None))
+        self.assertEqual(results[2][1][1]['code'], 504)
+
+        delays['yahoo.com'] = 0
+        results = services.share(targets)
+        self.assertEqual(results['yahoo.com'], ({'domain': 'yahoo.com'}, None))
+        self.assertRaises(ValueError, services.share, targets * 2)
+
+        # each domain gets its own headers
+        def _sendmessage(domain, account, message, options, headers):
+            headers['Content-type'] = domain
+            time.sleep(.1)
+            return {'domain': headers['Content-type']}, None
+
+        services.sendmessage = _sendmessage
+        headers = {'Accept': 'application/json'}
+        results = services.share(targets, headers=headers)
+        for domain, (res, error) in results.items():
+            self.assertEqual(res, {'domain': domain})
+        self.assertEqual(headers, {'Accept': 'application/json'})
+        services.close()
+
+    def test_async(self):
+        args = {'to': 'tarek@ziade.org',
+                'subject': 'xxx',
+                'title': 'the title',
+                'description': 'some description',
+                'link': 'http://example.com',
+                'shorturl': 'http://example.com'}
+
+        services = Services(['google.com'])
+        services.initialize('google.com')
+        done = []
+        tasks = [services.sendmessage_async('google.com', _ACCOUNT,
+                                            'message', args)
+                 for i in range(3)]
+        for task in tasks:
+            task.add_done_callback(done.append)
+        for task in tasks:
+            self.assertTrue(task.wait(5))
+            res, error = task.get()
+            self.assertEqual(error, None)
+        self.assertEqual(len(done), 3)
+        self.assertEquals(services.get_status('google.com'), (True, 3, 0))
+
+        # the exceptions are raised by get()
+        task = services.sendmessage_async('a', _ACCOUNT, 'message', args)
+        task.wait(5)
+        self.assertRaises(DomainNotRegisteredError, task.get)
+
+        # a batch does not hold back the async calls
+        release = threading.Event()
+
+        def _sendmessage(domain, account, message, options, headers,
+                         **kw):
+            if message == 'batch':
+                release.wait()
+            return {'message': message}, None
+
+        services.sendmessage = _sendmessage
+        items = [(_ACCOUNT, 'batch', args)] * 20
+        batch = threading.Thread(target=services.sendmessage_many,
+                                 args=('google.com', items))
+        batch.start()
+        try:
+            task = services.sendmessage_async('google.com', _ACCOUNT,
+                                              'async', args)
+            self.assertEqual(task.get(timeout=5), ({'message': 'async'},
+                                                   None))
+        finally:
+            release.set()
+            batch.join()
+        services.close()
+
+    def test_bulkheads(self):
+        services = Services(['google.com', 'yahoo.com'],
+                            bulkhead_sizes={'google.com': 1},
+                            bulkhead_timeout=.05)
+        services.initialize('google.com')
+        services.initialize('yahoo.com')
+        self.assertFalse('yahoo.com' in services.bulkheads)
+        started = threading.Event()
+        release = threading.Event()
+
+        class _Requester(object):
+            def sendmessage(self, message, options, headers=None):
+                if message == 'slow':
+                    started.set()
+                    release.wait()
+                return {'message': message}, None
+
+        services._get_requester = lambda domain, account: _Requester()
+        slow = threading.Thread(target=services.sendmessage,
+                                args=('google.com', _ACCOUNT, 'slow', {}))
+        slow.start()
+        started.wait()
+        try:
+            # google.com is full, the excess call fails fast
+            res, error = services.sendmessage('google.com', _ACCOUNT, 'xx',
+                                              {})
+            self.assertEqual(res, None)
+            self.assertEqual(error['code'], 503)
+            self.assertEquals(services.get_status('google.com'),
+                              (True, 0, 1))
+
+            # other domains are not affected
+            res, error = services.sendmessage('yahoo.com', _ACCOUNT, 'xx',
+                                              {})
+            self.assertEqual(error, None)
+        finally:
+            release.set()
+            slow.join()
+
+        # the slot is given back
+        res, error = services.sendmessage('google.com', _ACCOUNT, 'xx', {})
+        self.assertEqual(error, None)
+        self.assertEquals(services.get_status('google.com'), (True, 2, 1))
+        self.assertEqual(services.bulkheads['google.com'].active, 0)
+        services.close()
+
+    def test_timeout(self):
+        services = Services(['google.com'], timeout=10)
+        services.initialize('google.com')
+        budgets = []
+
+        class _Requester(object):
+            def sendmessage(self, message, options, headers=None):
+                budgets.append(time_left())
+                if message == 'slow':
+                    time.sleep(.2)
+                    time_left()
+                return {'message': message}, None
+
+        services._get_requester = lambda domain, account: _Requester()
+
+        # the default budget applies, an explicit one is used when shorter
+        res, error = services.sendmessage('google.com', _ACCOUNT, 'xx', {})
+        self.assertEqual(error, None)
+        self.assertTrue(9 < budgets[-1] <= 10)
+        services.sendmessage('google.com', _ACCOUNT, 'xx', {}, timeout=1)
+        self.assertTrue(budgets[-1] <= 1)
+
+        # a spent budget gives a timeout error
+        res, error = services.sendmessage('google.com', _ACCOUNT, 'slow',
+                                          {}, timeout=.1)
+        self.assertEqual(res, None)
+        self.assertEqual(error['code'], 504)
+        self.assertEquals(services.get_status('google.com'), (True, 2, 1))
+        self.assertEqual(time_left(), None)
+
+        # the budget is carried to the send threads
+        task = services.sendmessage_async('google.com', _ACCOUNT, 'slow', {},
+                                          timeout=.1)
+        task.wait(5)
+        self.assertEqual(task.get()[1]['code'], 504)
+        services.close()
+
+    def test_status_cache_down(self):
+        services = Services(['google.com'], bulkhead_size=1,
+                            bulkhead_timeout=0)
+
+        class _Requester(object):
+            def sendmessage(self, message, options, headers=None):
+                return {'message': message}, None
+
+        services._get_requester = lambda domain, account: _Requester()
+        services._cache.health.down = True
+        try:
+            # the status cannot be updated, the result is still returned
+            res, error = services.sendmessage('google.com', _ACCOUNT, 'xx',
+                                              {})
+            self.assertEqual(res, {'message': 'xx'})
+            self.assertEqual(error, None)
+
+            # and so are the errors of Services
+            services.bulkheads['google.com'].acquire()
+            res, error = services.sendmessage('google.com', _ACCOUNT, 'xx',
+                                              {})
+            self.assertEqual(error['code'], 503)
+        finally:
+            services._cache.health.down = False
+            services.close()
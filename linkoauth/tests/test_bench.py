@@ -0,0 +1,57 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Raindrop.
+#
+# The Initial Developer of the Original Code is
+# Mozilla Messaging, Inc..
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+import copy
+import unittest
+
+from linkoauth import bench
+
+
+class TestBench(unittest.TestCase):
+
+    def test_run(self):
+        report = bench.Bench(duration=.05).run(services=(2,), threads=(2,))
+        self.assertEqual(report['backend'], 'mmap')
+        results = dict([(bench._result_key(result), result)
+                        for result in report['results']])
+        self.assertEqual(len(results),
+                         len(bench.STATES) + len(bench.UPDATE_MODES))
+        for result in results.values():
+            self.assertTrue(result['calls'] > 0)
+            latency = result['latency']
+            self.assertTrue(latency['p50'] <= latency['p95'] <=
+                            latency['p99'])
+
+        # a report does not regress from itself
+        self.assertEqual(bench.compare(report, report), [])
+        slower = copy.deepcopy(report)
+        slower['results'][0]['throughput'] /= 2
+        regressions = bench.compare(slower, report, tolerance=.2)
+        self.assertEqual(len(regressions), 1)
+        self.assertEqual(regressions[0][0],
+                         bench._result_key(report['results'][0]))
+
+    def test_servers(self):
+        # every thread gets its own memcached client
+        options = bench.Bench(servers=['127.0.0.1:11211'])._backend(16)
+        self.assertEqual(options, {'cache_servers': ['127.0.0.1:11211'],
+                                   'cache_pool_size': 17})
@@ -0,0 +1,162 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Raindrop.
+#
+# The Initial Developer of the Original Code is
+# Mozilla Messaging, Inc..
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+import mock
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from pylibmc import NotFound
+
+from linkoauth import sstatus
+from linkoauth.mmapcache import MmapClient
+
+
+class TestMmapClient(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'status')
+        self.client = MmapClient(self.path, slots=64)
+
+    def tearDown(self):
+        self.client.close()
+        shutil.rmtree(self.dir)
+
+    def test_client(self):
+        client = self.client
+        self.assertEqual(client.get('a'), None)
+        client.set('a', True)
+        client.set('b', 12)
+        client.set('c', '\x00\x01packed')
+        self.assertEqual(client.get_multi(['a', 'b', 'c', 'd']),
+                         {'a': True, 'b': 12, 'c': '\x00\x01packed'})
+
+        self.assertEqual(client.incr('b', 3), 15)
+        self.assertRaises(NotFound, client.incr, 'd')
+
+        self.assertFalse(client.add('b', 0))
+        self.assertTrue(client.add('d', 0))
+        self.assertEqual(client.add_multi({'d': 1, 'e': 2}), ['d'])
+
+        value, cas_id = client.gets('b')
+        self.assertTrue(client.cas('b', 20, cas_id))
+        self.assertFalse(client.cas('b', 30, cas_id))
+        self.assertEqual(client.get('b'), 20)
+
+        client.delete_multi(['a', 'b'])
+        self.assertEqual(client.get_multi(['a', 'b']), {})
+
+    def test_ttl(self):
+        self.client.set('a', 1, time=1)
+        self.assertEqual(self.client.get('a'), 1)
+        time.sleep(1.1)
+        self.assertEqual(self.client.get('a'), None)
+        # the expired slots are reused
+        for i in range(200):
+            self.client.set('key%d' % i, i, time=.01)
+            time.sleep(.001)
+
+    def test_churn(self):
+        now = [1000.]
+        patch = mock.patch('linkoauth.mmapcache._now', lambda: now[0])
+        patch.start()
+        try:
+            self.client.set('stays', 1)
+            for i in range(1000):
+                self.client.set('key%d' % i, i, time=1)
+                self.client.add('claim%d' % i, True, time=1)
+                now[0] += .1
+            self.client.delete_multi(['key%d' % i for i in range(990, 1000)])
+            self.assertEqual(self.client.get('missing'), None)
+            self.assertEqual(self.client.get('stays'), 1)
+            self.assertEqual(self.client.get('claim999'), True)
+
+            # the misses do not have to step over the tombstones
+            tombstones = [index for index in range(self.client.slots)
+                          if self.client._read_slot(index)[0] == 2]
+            self.assertTrue(len(tombstones) <= 32, len(tombstones))
+        finally:
+            patch.stop()
+
+    def test_processes(self):
+        self.client.set('counter', 0)
+        pids = []
+        for i in range(4):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    client = MmapClient(self.path)
+                    for j in range(50):
+                        client.incr('counter')
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+
+        for pid in pids:
+            os.waitpid(pid, 0)
+        self.assertEqual(self.client.get('counter'), 200)
+
+    def test_services_status(self):
+        services = sstatus.ServicesStatus(['a', 'b'], mmap_path=self.path)
+        for i in range(10):
+            services.update_status('a', True)
+        services.update_status('a', False)
+        services.disable('b')
+        self.assertEqual(services.get_statuses(['a', 'b']),
+                         {'a': (True, 10, 1), 'b': (False, 0, 0)})
+
+        # another instance sees the same statuses
+        other = sstatus.ServicesStatus(['a', 'b'], mmap_path=self.path)
+        self.assertEqual(other.get_status('a'), (True, 10, 1))
+
+        other.initialize('a')
+        self.assertEqual(services.get_status('a'), (True, 0, 0))
+
+        # other layouts work too
+        packed = sstatus.ServicesStatus(['c'], mmap_path=self.path,
+                                        packed=True)
+        packed.update_counts('c', 3, 2)
+        self.assertEqual(packed.get_status('c'), (True, 3, 2))
+
+        window = sstatus.ServicesStatus(['d'], mmap_path=self.path,
+                                        bucket_size=10, buckets=6)
+        window.update_counts('d', 3, 2)
+        window.update_status('d', True)
+        self.assertEqual(window.get_status('d'), (True, 4, 2))
+
+    def test_history(self):
+        services = sstatus.ServicesStatus(['a'], mmap_path=self.path,
+                                          bucket_size=.5, buckets=3,
+                                          history_size=2,
+                                          history_interval=None)
+        services.update_counts('a', 3, 1)
+        for now in (10, 20, 30):
+            services.record_history(['a'], now)
+
+        # the snapshots fit in the values of the file
+        history = services.get_history(['a'])['a']
+        self.assertEqual([snapshot[0] for snapshot in history], [20, 30])
+        self.assertEqual(history[-1][1:3], (3, 1))
+        self.assertEqual(history[-1][5], 2)
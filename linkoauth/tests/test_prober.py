@@ -0,0 +1,116 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Raindrop.
+#
+# The Initial Developer of the Original Code is
+# Mozilla Messaging, Inc..
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+import mock
+import time
+import socket
+import unittest
+
+from linkoauth import prober, sstatus
+from linkoauth.util import time_left
+from linkoauth.errors import OAuthKeysException
+from linkoauth.tests.test_base import MockCache
+
+
+class FakeRequester(object):
+    def __init__(self, domain, account):
+        self.domain = domain
+        self.account = account
+
+    def probe(self):
+        behavior = self.account['behavior']
+        if behavior == 'ok':
+            return {'id': 1}, None
+        if behavior == 'down':
+            return None, {'status': 503, 'message': 'over capacity'}
+        if behavior == 'revoked':
+            return None, {'status': 401, 'message': 'invalid token'}
+        if behavior == 'hung':
+            # the HTTP clients give up at the deadline
+            for i in range(100):
+                time_left()
+                time.sleep(.01)
+            return {'id': 1}, None
+        raise socket.error('connection refused')
+
+
+def _get_requester(domain, account):
+    if account is None:
+        raise OAuthKeysException()
+    return FakeRequester(domain, account)
+
+
+class TestProber(unittest.TestCase):
+
+    def setUp(self):
+        self.mcclient_patcher = mock.patch('linkoauth.sstatus.Client')
+        self.mcclient_patcher.start()
+        sstatus.Client.return_value = MockCache()
+        self.requester_patcher = mock.patch('linkoauth.prober.get_requester',
+                                            _get_requester)
+        self.requester_patcher.start()
+        self.accounts = {'a': {'behavior': 'ok'},
+                         'b': {'behavior': 'down'},
+                         'c': {'behavior': 'revoked'},
+                         'd': {'behavior': 'unreachable'},
+                         'e': None}
+        self.status = sstatus.ServicesStatus(self.accounts.keys())
+
+    def tearDown(self):
+        self.requester_patcher.stop()
+        self.mcclient_patcher.stop()
+
+    def test_tick(self):
+        probes = [prober.ServicesProber(self.status, self.accounts, 60)
+                  for i in range(2)]
+        probes[0].tick(30)
+        # the second process does not probe during the same interval
+        probes[1].tick(40)
+        self.assertEqual(probes[1].results, {})
+
+        results = probes[0].results
+        self.assertTrue(results['a'][1])
+        self.assertFalse(results['b'][1])
+        self.assertEqual(results['c'][1], None)
+        self.assertFalse(results['d'][1])
+        self.assertEqual(results['e'][1], None)
+
+        statuses = self.status.get_statuses(['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(statuses['a'], (True, 1, 0))
+        self.assertEqual(statuses['b'], (True, 0, 1))
+        # a revoked probe account is not an outage
+        self.assertEqual(statuses['c'], (True, 0, 0))
+        self.assertEqual(statuses['d'], (True, 0, 1))
+        self.assertEqual(statuses['e'], (True, 0, 0))
+
+        probes[1].tick(90)
+        self.assertEqual(self.status.get_status('a'), (True, 2, 0))
+
+    def test_timeout(self):
+        accounts = {'a': {'behavior': 'hung'}, 'b': {'behavior': 'ok'}}
+        probe = prober.ServicesProber(self.status, accounts, 60, timeout=.1)
+        start = time.time()
+        probe.tick()
+        self.assertTrue(time.time() - start < .5)
+        # the hung provider failed, the other one was probed
+        self.assertFalse(probe.results['a'][1])
+        self.assertTrue(probe.results['b'][1])
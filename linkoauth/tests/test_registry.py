@@ -20,10 +20,12 @@
 #
 # Contributor(s):
 #
+import time
 import unittest
 
-from linkoauth.backends import get_responder, get_requester
+from linkoauth.backends import get_responder, get_requester, RequesterCache
 from linkoauth.util import setup_config
+from linkoauth.oauth import get_oauth_config
 
 
 _CONFIG = {'oauth.yahoo.com.consumer_key': 'xxx',
@@ -52,3 +54,39 @@ class TestRegistry(unittest.TestCase):
             obj = get_requester(domain, account)
             self.assertTrue(hasattr(obj, 'sendmessage'))
             self.assertTrue(hasattr(obj, 'getcontacts'))
+            self.assertTrue(hasattr(obj, 'probe'))
+
+        # the oauth consumers are shared
+        setup_config(dict(_CONFIG, **{
+            'oauth.google.com.consumer_key': 'xxx',
+            'oauth.google.com.consumer_secret': 'xxx'}))
+        for domain in ('google.com', 'twitter.com', 'yahoo.com',
+                       'linkedin.com'):
+            obj = get_requester(domain, account)
+            self.assertTrue(obj.consumer is get_oauth_config(domain).consumer)
+
+    def test_requester_cache(self):
+        cache = RequesterCache(size=2, ttl=.2)
+        account = {'oauth_token': 'xxx', 'oauth_token_secret': 'xxx'}
+        other = {'oauth_token': 'yyy', 'oauth_token_secret': 'yyy'}
+
+        requester = cache.get('twitter.com', account)
+        self.assertTrue(cache.get('twitter.com', dict(account)) is requester)
+        self.assertFalse(cache.get('twitter.com', other) is requester)
+        self.assertFalse(cache.get('yahoo.com', account) is requester)
+
+        # the least recently used one was dropped
+        self.assertEqual(len(cache), 2)
+        self.assertFalse(cache.get('twitter.com', account) is requester)
+
+        requester = cache.get('twitter.com', account)
+        cache.invalidate('twitter.com', account)
+        self.assertFalse(cache.get('twitter.com', account) is requester)
+
+        requester = cache.get('twitter.com', account)
+        cache.invalidate('twitter.com')
+        self.assertFalse(cache.get('twitter.com', account) is requester)
+
+        requester = cache.get('twitter.com', account)
+        time.sleep(.3)
+        self.assertFalse(cache.get('twitter.com', account) is requester)
@@ -22,6 +22,7 @@
 #
 import mock
 import time
+import threading
 import unittest
 from linkoauth import sstatus
 #import ServicesStatus, ServicesStatusMiddleware
@@ -134,3 +135,619 @@ class TestServiceStatus(unittest.TestCase):
 
         finally:
             services.initialize('d')
+
+    def test_get_statuses(self):
+        self._ping_status('a', succ=3, fail=1)
+        self._ping_status('b', succ=2, fail=0)
+        self.services.disable('c')
+
+        calls = []
+        get_multi = self.mock_cache.get_multi
+
+        def _get_multi(keys):
+            calls.append(keys)
+            return get_multi(keys)
+
+        self.mock_cache.get_multi = _get_multi
+        statuses = self.services.get_statuses(['a', 'b', 'c'])
+        self.assertEqual(statuses, {'a': (True, 3, 1),
+                                    'b': (True, 2, 0),
+                                    'c': (False, 0, 0)})
+        # a single round trip
+        self.assertEqual(len(calls), 1)
+
+    def test_snapshot(self):
+        app = sstatus.ServicesStatusMiddleware(FakeWSGIApp(), ['a', 'b'],
+                                               [0.5, 0.5],
+                                               snapshot_interval=60)
+        try:
+            request = FakeEnviron()
+            request['HTTP_X_TARGET_DOMAIN'] = 'a'
+
+            def start_response(status, headers):
+                pass
+
+            self._ping_status(succ=0, fail=20)
+
+            # the snapshot was taken before the failures
+            res = app(request, start_response)
+            self.assertEqual(res[0], 'Hello World')
+
+            app._snapshot.refresh()
+            res = app(request, start_response)
+            self.assertEqual(res[0], 'The service is unavailable')
+
+            # a stale snapshot is not used
+            self.services.initialize('a')
+            app._snapshot.max_age = 0
+            time.sleep(.01)
+            res = app(request, start_response)
+            self.assertEqual(res[0], 'Hello World')
+        finally:
+            app._snapshot.stop()
+
+    def test_write_behind(self):
+        services = sstatus.ServicesStatus(['a', 'b'], flush_interval=60,
+                                          flush_events=5)
+        try:
+            for i in range(3):
+                services.update_status('a', True)
+            services.update_status('b', False)
+
+            # nothing was written yet
+            self.assertEqual(services.get_status('a'), (True, 0, 0))
+            self.assertEqual(services.get_status('b'), (True, 0, 0))
+
+            services.flush()
+            self.assertEqual(services.get_status('a'), (True, 3, 0))
+            self.assertEqual(services.get_status('b'), (True, 0, 1))
+
+            # reaching flush_events wakes up the flusher
+            for i in range(5):
+                services.update_status('a', False)
+
+            for i in range(100):
+                if services.get_status('a') == (True, 3, 5):
+                    break
+                time.sleep(.01)
+            self.assertEqual(services.get_status('a'), (True, 3, 5))
+        finally:
+            services.close()
+
+    def test_update_counts(self):
+        self._ping_status(succ=3, fail=2)
+        self.services.update_counts('a', 2, 1)
+        self.assertEqual(self.services.get_status('a'), (True, 5, 3))
+
+        # only the failures ttl-ed, the successes are kept
+        del self.mock_cache._cache['service:a:fail']
+        self.services.update_counts('a', 2, 1)
+        self.assertEqual(self.services.get_status('a'), (True, 7, 1))
+
+        # same for the single updates
+        del self.mock_cache._cache['service:a:fail']
+        self.services.update_status('a', False)
+        self.assertEqual(self.services.get_status('a'), (True, 7, 1))
+
+    def test_sliding_window(self):
+        services = sstatus.ServicesStatus(['a'], bucket_size=10, buckets=6)
+        self._ping_status(succ=3, fail=2)
+        services.update_status('a', True)
+        services.update_status('a', False)
+        services.update_counts('a', 2, 1)
+
+        # the ttl counters and the window are separate
+        self.assertEqual(services.get_status('a'), (True, 3, 2))
+        on, buckets = services.get_buckets(['a'])['a']
+        self.assertEqual(len(buckets), 6)
+        self.assertEqual(buckets[-1][1:], (3, 2))
+
+        services.initialize('a')
+        self.assertEqual(services.get_status('a'), (True, 0, 0))
+
+    def test_circuit_breaker(self):
+        breaker = sstatus.CircuitBreaker(0.5, open_timeout=30, probes=2,
+                                         min_requests=10)
+
+        def window(*counts):
+            return [(i * 10, succ, fail)
+                    for i, (succ, fail) in enumerate(counts)]
+
+        healthy = window((100, 1), (100, 0), (100, 0))
+        self.assertTrue(breaker.allow(healthy, now=30))
+        self.assertEqual(breaker.state, sstatus.CLOSED)
+
+        # the provider dies: the recent buckets trip the breaker even
+        # though the whole window is still fine
+        dying = window((100, 1), (100, 0), (5, 30), (1, 20))
+        self.assertFalse(breaker.allow(dying, now=31))
+        self.assertEqual(breaker.state, sstatus.OPEN)
+        self.assertFalse(breaker.allow(dying, now=40))
+
+        # after open_timeout, a limited number of probes go through
+        self.assertTrue(breaker.allow(dying, now=62))
+        self.assertEqual(breaker.state, sstatus.HALF_OPEN)
+        self.assertTrue(breaker.allow(dying, now=62))
+        self.assertFalse(breaker.allow(dying, now=62))
+
+        # a probe failed
+        failed = window((100, 1), (100, 0), (5, 30), (1, 21))
+        self.assertFalse(breaker.allow(failed, now=63))
+        self.assertEqual(breaker.state, sstatus.OPEN)
+
+        # the probes succeed
+        self.assertTrue(breaker.allow(failed, now=94))
+        recovered = window((100, 1), (100, 0), (5, 30), (3, 21))
+        self.assertTrue(breaker.allow(recovered, now=95))
+        self.assertEqual(breaker.state, sstatus.CLOSED)
+
+        # the failures of the outage are still in the window, only the
+        # new calls are judged
+        self.assertTrue(breaker.allow(recovered, now=96))
+        self.assertEqual(breaker.state, sstatus.CLOSED)
+        again = window((100, 1), (100, 0), (5, 30), (3, 41))
+        self.assertFalse(breaker.allow(again, now=97))
+        self.assertEqual(breaker.state, sstatus.OPEN)
+
+    def test_middleware_breaker(self):
+        app = sstatus.ServicesStatusMiddleware(FakeWSGIApp(), ['a'], [0.5],
+                                               bucket_size=10, buckets=6,
+                                               open_timeout=.1, probes=1)
+        services = sstatus.ServicesStatus(['a'], bucket_size=10, buckets=6)
+        request = FakeEnviron()
+        request['HTTP_X_TARGET_DOMAIN'] = 'a'
+
+        def start_response(status, headers):
+            pass
+
+        for i in range(20):
+            services.update_status('a', False)
+
+        res = app(request, start_response)
+        self.assertEqual(res[0], 'The service is unavailable')
+
+        # half-open, one probe goes through
+        time.sleep(.2)
+        res = app(request, start_response)
+        self.assertEqual(res[0], 'Hello World')
+        res = app(request, start_response)
+        self.assertEqual(res[0], 'The service is unavailable')
+
+        # the probe worked
+        services.update_status('a', True)
+        res = app(request, start_response)
+        self.assertEqual(res[0], 'Hello World')
+        self.assertEqual(app._breakers[0].state, sstatus.CLOSED)
+
+        # and stays closed, the outage is still in the window
+        res = app(request, start_response)
+        self.assertEqual(res[0], 'Hello World')
+        self.assertEqual(app._breakers[0].state, sstatus.CLOSED)
+
+    def test_packed(self):
+        services = sstatus.ServicesStatus(['e', 'f'], packed=True, ttl=1)
+        services.update_status('e', True)
+        services.update_status('e', False)
+        services.update_counts('e', 3, 1)
+        services.disable('f')
+
+        self.assertEqual(services.get_statuses(['e', 'f']),
+                         {'e': (True, 4, 2), 'f': (False, 0, 0)})
+        # a single key per service
+        self.assertEqual(len(self.mock_cache.get_multi(['service:e',
+                                                        'service:f'])), 2)
+        self.assertFalse('service:e:succ' in self.mock_cache._cache)
+
+        # concurrent writers are retried
+        cas = self.mock_cache.cas
+        conflicts = []
+
+        def _cas(key, value, cas_id, **kwargs):
+            if not conflicts:
+                conflicts.append(key)
+                services.update_status('e', True)
+            return cas(key, value, cas_id, **kwargs)
+
+        self.mock_cache.cas = _cas
+        services.update_status('e', True)
+        self.assertEqual(services.get_status('e'), (True, 6, 2))
+
+        # the window expires
+        time.sleep(1.1)
+        self.assertEqual(services.get_status('e'), (True, 0, 0))
+        services.update_status('e', False)
+        self.assertEqual(services.get_status('e'), (True, 0, 1))
+
+    def test_bulk_initialization(self):
+        calls = []
+        get_multi = self.mock_cache.get_multi
+
+        def _get_multi(keys):
+            calls.append(keys)
+            return get_multi(keys)
+
+        self.mock_cache.get_multi = _get_multi
+
+        # another client already has a status for 'g'
+        self.mock_cache.set('service:g:on', False)
+        services = sstatus.ServicesStatus(['g', 'h', 'i'])
+        self.assertEqual(len(calls), 1)
+
+        # the initialization is not done again
+        services.get_status('h')
+        services.get_status('h')
+        self.assertEqual(len(calls), 3)
+
+        # add did not overwrite the existing status
+        self.assertEqual(services.get_statuses(['g', 'h']),
+                         {'g': (False, 0, 0), 'h': (True, 0, 0)})
+        services.initialize('g')
+
+    def test_cache_restart(self):
+        app = sstatus.ServicesStatusMiddleware(FakeWSGIApp(), ['a', 'b'],
+                                               [0.5, 0.5])
+        request = FakeEnviron(HTTP_X_TARGET_DOMAIN='a')
+
+        def start_response(status, headers):
+            pass
+
+        self.assertEqual(app(request, start_response)[0], 'Hello World')
+
+        # memcached restarted, or evicted the keys
+        self.mock_cache._cache.clear()
+        self.assertEqual(self.services.get_status('a'), (True, 0, 0))
+        self.assertEqual(app(request, start_response)[0], 'Hello World')
+
+        # the keys are added back
+        self.services.get_status('a')
+        self.assertTrue(self.mock_cache.get('service:a:on'))
+        self.assertTrue(self.mock_cache.get('service:b:on'))
+
+    def test_client_pool(self):
+        clones = []
+
+        class _Client(MockCache):
+            def clone(self):
+                clone = _Client()
+                clone._cache = self._cache
+                clones.append(clone)
+                return clone
+
+            def get(self, key):
+                if getattr(self, 'broken', False):
+                    raise sstatus.ConnectionError()
+                return MockCache.get(self, key)
+
+        master = _Client()
+        pool = sstatus.ClientPool(master, size=2)
+        self.assertEqual(len(clones), 2)
+
+        pool.set('key', 1)
+        self.assertEqual(pool.get('key'), 1)
+
+        # a broken client gets replaced
+        for clone in clones:
+            clone.broken = True
+        self.assertRaises(sstatus.ConnectionError, pool.get, 'key')
+        self.assertEqual(len(clones), 3)
+
+        # a status with a pool can be used by several threads
+        services = sstatus.ServicesStatus(['j'], pool_size=4)
+
+        def _ping():
+            for i in range(5):
+                services.update_status('j', True)
+                services.update_status('j', False)
+
+        threads = [threading.Thread(target=_ping) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(services.get_status('j'), (True, 20, 20))
+
+        # the background threads do not share a single client
+        for options in ({'flush_interval': 60}, {'queue_size': 5},
+                        {'history_size': 3}):
+            services = sstatus.ServicesStatus(['j'], **options)
+            try:
+                self.assertTrue(isinstance(services._cache._cache,
+                                           sstatus.ClientPool))
+            finally:
+                services.close()
+        services = sstatus.ServicesStatus(['j'], history_size=3,
+                                          history_interval=None)
+        self.assertFalse(isinstance(services._cache._cache,
+                                    sstatus.ClientPool))
+
+    def test_async_updates(self):
+        services = sstatus.ServicesStatus(['k'], queue_size=5)
+        # block the worker
+        lock = threading.Lock()
+        lock.acquire()
+        write_status = services._write_status
+
+        def _write_status(*args):
+            with lock:
+                return write_status(*args)
+
+        services._write_status = _write_status
+        try:
+            services.update_status('k', True)
+            while services.update_stats()['queued']:
+                time.sleep(.01)
+
+            for i in range(9):
+                self.assertEqual(services.update_status('k', True), None)
+        finally:
+            lock.release()
+            services.close()
+
+        # the worker held one update, 5 were kept in the queue
+        stats = services.update_stats()
+        self.assertEqual(stats['dropped'], 4)
+        self.assertEqual(stats['written'], 6)
+        self.assertEqual(stats['queued'], 0)
+        self.assertEqual(services.get_status('k'), (True, 6, 0))
+
+    def test_latencies(self):
+        self.assertEqual(sstatus.latency_bin(.01), 0)
+        self.assertEqual(sstatus.latency_bin(3), 6)
+        self.assertEqual(sstatus.latency_bin(60), len(sstatus.LATENCY_BINS))
+
+        histogram = [90, 0, 0, 0, 0, 0, 0, 5, 5, 0]
+        self.assertEqual(sstatus.latency_percentile(histogram, .5), .05)
+        self.assertEqual(sstatus.latency_percentile(histogram, .95), 10.)
+        self.assertEqual(sstatus.latency_percentile(histogram, .99), 20.)
+        self.assertEqual(sstatus.latency_percentile([0] * 10, .99), None)
+
+        self.services.update_status('a', True, .02)
+        self.services.update_status('a', False, 30)
+        histogram = self.services.get_latencies(['a'])['a']
+        self.assertEqual(histogram[0], 1)
+        self.assertEqual(histogram[-1], 1)
+
+        status, histogram = self.services.get_health(['a'])['a']
+        self.assertEqual(status, (True, 1, 1))
+        self.assertEqual(sum(histogram), 2)
+
+    def test_middleware_latency(self):
+        app = sstatus.ServicesStatusMiddleware(FakeWSGIApp(), ['a', 'b'],
+                                               [0.1, 0.1],
+                                               latency_tresholds=[5., None],
+                                               latency_min_requests=5)
+        request = FakeEnviron()
+
+        def start_response(status, headers):
+            pass
+
+        # slow successes
+        for i in range(10):
+            self.services.update_status('a', True, 15.)
+            self.services.update_status('b', True, 15.)
+
+        request['HTTP_X_TARGET_DOMAIN'] = 'a'
+        res = app(request, start_response)
+        self.assertEqual(res[0], 'The service is unavailable')
+
+        # no treshold for b
+        request['HTTP_X_TARGET_DOMAIN'] = 'b'
+        res = app(request, start_response)
+        self.assertEqual(res[0], 'Hello World')
+
+        # a is fast again
+        self.services.initialize('a')
+        for i in range(10):
+            self.services.update_status('a', True, .2)
+        request['HTTP_X_TARGET_DOMAIN'] = 'a'
+        res = app(request, start_response)
+        self.assertEqual(res[0], 'Hello World')
+
+    def test_cache_down(self):
+        services = sstatus.ServicesStatus(['l'], cache_max_errors=2,
+                                          cache_backoff=.1)
+        calls = []
+        get_multi = self.mock_cache.get_multi
+        get = self.mock_cache.get
+
+        def _down(*args):
+            calls.append(args)
+            raise sstatus.ConnectionError()
+
+        self.mock_cache.get_multi = self.mock_cache.get = _down
+
+        # the errors are counted, then the cache is skipped
+        self.assertRaises(sstatus.StatusReadError, services.get_status, 'l')
+        self.assertRaises(sstatus.StatusReadError, services.get_status, 'l')
+        self.assertTrue(services._cache.health.down)
+        self.assertRaises(sstatus.StatusReadError, services.get_status, 'l')
+        self.assertRaises(sstatus.StatusWriteError, services.update_status,
+                          'l', True)
+        self.assertEqual(len(calls), 2)
+
+        # the background probe notices the cache is back
+        self.mock_cache.get_multi = get_multi
+        self.mock_cache.get = get
+        for i in range(100):
+            if not services._cache.health.down:
+                break
+            time.sleep(.01)
+        self.assertEqual(services.get_status('l'), (True, 0, 0))
+
+    def test_retry_after(self):
+        app = sstatus.ServicesStatusMiddleware(FakeWSGIApp(), ['a'], [0.5],
+                                               retry_jitter=0)
+        request = FakeEnviron()
+        request['HTTP_X_TARGET_DOMAIN'] = 'a'
+        responses = []
+
+        def start_response(status, headers):
+            responses.append(dict(headers))
+
+        self._ping_status(succ=10, fail=40)
+        app(request, start_response)
+        # 80% of failures
+        self.assertEqual(responses[-1]['Retry-After'], str(30 + 570 * 8 / 10))
+
+        # with jitter
+        app.retry_jitter = .2
+        for i in range(20):
+            app(request, start_response)
+            retry_after = int(responses[-1]['Retry-After'])
+            self.assertTrue(486 * .8 - 1 <= retry_after <= 486 * 1.2)
+
+    def test_ramp(self):
+        app = sstatus.ServicesStatusMiddleware(FakeWSGIApp(), ['a'], [0.5],
+                                               ramp_duration=1000)
+        request = FakeEnviron()
+        request['HTTP_X_TARGET_DOMAIN'] = 'a'
+
+        def start_response(status, headers):
+            pass
+
+        self.assertEqual(app(request, start_response)[0], 'Hello World')
+
+        self.services.disable('a')
+        res = app(request, start_response)
+        self.assertEqual(res[0], 'The service is unavailable')
+
+        # just recovered, the requests are let through progressively
+        self.services.enable('a')
+        for i in range(10):
+            res = app(request, start_response)
+            self.assertEqual(res[0], 'The service is unavailable')
+
+        # the ramp is over
+        app._recovered[0] = time.time() - 1000
+        res = app(request, start_response)
+        self.assertEqual(res[0], 'Hello World')
+        self.assertEqual(app._recovered[0], None)
+
+    def test_lease_tokens(self):
+        # the bucket starts full
+        self.assertEqual(self.services.lease_tokens('a', 1, 5, 3), 3)
+        self.assertEqual(self.services.lease_tokens('a', 1, 5, 3), 2)
+        self.assertEqual(self.services.lease_tokens('a', 1, 5, 3), 0)
+
+        # then it refills
+        time.sleep(1.1)
+        self.assertEqual(self.services.lease_tokens('a', 1, 5, 3), 1)
+
+    def test_middleware_rate_limits(self):
+        app = sstatus.ServicesStatusMiddleware(FakeWSGIApp(), ['a', 'b'],
+                                               [0.5, 0.5],
+                                               rate_limits=[.1, None],
+                                               rate_bursts=[3, None],
+                                               lease_size=2)
+        request = FakeEnviron()
+        calls = []
+        lease_tokens = app._status_checker.lease_tokens
+
+        def _lease_tokens(*args):
+            calls.append(args)
+            return lease_tokens(*args)
+
+        app._status_checker.lease_tokens = _lease_tokens
+        responses = []
+
+        def start_response(status, headers):
+            responses.append(dict(headers))
+
+        request['HTTP_X_TARGET_DOMAIN'] = 'a'
+        results = [app(request, start_response)[0] for i in range(5)]
+        self.assertEqual(results, ['Hello World'] * 3 +
+                                  ['The service is unavailable'] * 2)
+        self.assertEqual(responses[-1]['Retry-After'], '10')
+        # the tokens were leased 2 at a time
+        self.assertEqual(len(calls), 3)
+
+        # no limit on b
+        request['HTTP_X_TARGET_DOMAIN'] = 'b'
+        for i in range(5):
+            self.assertEqual(app(request, start_response)[0], 'Hello World')
+
+    def test_history(self):
+        services = sstatus.ServicesStatus(['a', 'b'], history_size=3,
+                                          history_interval=None)
+        self.assertEqual(services._recorder, None)
+        services.update_status('a', True, .02)
+        services.update_status('a', False)
+        services.update_rejects('b', 4)
+        for now in (10, 20, 30, 40):
+            services.update_status('a', True)
+            services.record_history(['a', 'b'], now)
+
+        # the ring keeps the last 3 snapshots
+        history = services.get_history(['a', 'b'])
+        self.assertEqual([snapshot[:3] for snapshot in history['a']],
+                         [(20, 3, 1), (30, 4, 1), (40, 5, 1)])
+        self.assertAlmostEqual(history['a'][0][3], .05)
+        self.assertEqual(history['b'][-1], (40, 0, 0, -1, 4, 0))
+
+        # only one recorder gets a given period
+        recorders = [sstatus.HistoryRecorder(services, ['a'], 60)
+                     for i in range(2)]
+        self.assertEqual([recorder.tick(125) for recorder in recorders],
+                         [True, False])
+        self.assertEqual(services.get_history(['a'])['a'][-1][0], 125)
+
+        # the window sums are flagged with the length of the window
+        window = sstatus.ServicesStatus(['w'], bucket_size=10, buckets=6,
+                                        history_size=3,
+                                        history_interval=None)
+        window.update_status('w', True)
+        window.record_history(['w'], 50)
+        self.assertEqual(window.get_history(['w'])['w'][-1][5], 60)
+
+    def test_init_missing(self):
+        reader = sstatus.ServicesStatus(['r'], packed=True,
+                                        init_missing=False)
+        self.assertEqual(reader.get_status('r'), (True, 0, 0))
+        # the reads did not add the missing status
+        self.assertFalse('service:r' in self.mock_cache._cache)
+
+    def test_fleet(self):
+        class Unreachable(object):
+            def get_statuses(self, services):
+                raise sstatus.StatusReadError()
+
+        class Slow(object):
+            def get_statuses(self, services):
+                time.sleep(.5)
+                return {}
+
+        def connect(server):
+            if server == 'hung':
+                # the clients are created in the reader threads
+                time.sleep(.5)
+            return checkers[server]
+
+        self._ping_status('a', 3, 1)
+        checkers = {'one': self.services, 'two': self.services,
+                    'down': Unreachable(), 'slow': Slow(),
+                    'hung': self.services}
+        start = time.time()
+        previous = sstatus._fleet_statuses(connect, checkers, ['a', 'b'],
+                                           timeout=.2)
+        self.assertTrue(time.time() - start < .5)
+        self.assertEqual(previous['down'], None)
+        self.assertEqual(previous['slow'], None)
+        self.assertEqual(previous['hung'], None)
+        self.assertEqual(previous['one']['a'], (True, 3, 1))
+
+        total = sstatus._fleet_total(previous, ['a', 'b'])
+        self.assertEqual(total, {'a': (True, 6, 2), 'b': (True, 0, 0)})
+
+        self.services.disable('b')
+        self._ping_status('a', 2, 0)
+        current = sstatus._fleet_statuses(connect, checkers, ['a', 'b'],
+                                          timeout=.2)
+        rates = sstatus._fleet_rates(previous, current, ['a', 'b'], 2.)
+        self.assertEqual(rates, {'a': (True, 2., 0.), 'b': (False, 0., 0.)})
+
+        # the sliding windows are compared bucket by bucket, the bucket
+        # that left the window is not a drop
+        previous = {'one': {'a': (True, [(0, 5, 1), (10, 2, 0)])}}
+        current = {'one': {'a': (True, [(10, 4, 0), (20, 1, 1)])}}
+        rates = sstatus._fleet_rates(previous, current, ['a'], 1.)
+        self.assertEqual(rates, {'a': (True, 3., 1.)})
@@ -0,0 +1,82 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Raindrop.
+#
+# The Initial Developer of the Original Code is
+# Mozilla Messaging, Inc..
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+import unittest
+
+from nose.plugins.skip import SkipTest
+from linkoauth import trends
+
+
+class TestTrends(unittest.TestCase):
+
+    def setUp(self):
+        if trends.numpy is None:
+            raise SkipTest('NumPy is not installed')
+
+    def test_analyze(self):
+        history = {}
+        # a steady 10 req/s with 1% of failures, then an outage
+        snapshots, succ, fail = [], 0, 0
+        for step in range(10):
+            if step < 8:
+                succ, fail = succ + 594, fail + 6
+            else:
+                succ, fail = succ + 300, fail + 300
+            snapshots.append((step * 60., succ, fail, .25, 0))
+        history['a'] = snapshots
+        # a shorter history, with a reset of the counters
+        history['b'] = [(420., 100, 0, -1, 0), (480., 200, 0, -1, 2),
+                        (540., 50, 0, -1, 3)]
+        history['c'] = []
+
+        result = trends.analyze(history)
+        a = result['a']
+        self.assertEqual(len(a['times']), 9)
+        self.assertEqual(a['times'][0], 60.)
+        self.assertAlmostEqual(a['succ_rate'][0], 9.9)
+        self.assertAlmostEqual(a['ratio'][0], .01)
+        self.assertAlmostEqual(a['ewma'][6], .01)
+        self.assertFalse(a['anomaly'][:7].any())
+        self.assertTrue(a['anomaly'][7])
+        self.assertTrue(.01 < a['ewma'][7] < .5)
+
+        b = result['b']
+        self.assertEqual(list(b['times']), [480., 540.])
+        # the counters were reset, the rate uses the new value
+        self.assertAlmostEqual(b['succ_rate'][1], 50 / 60.)
+        self.assertEqual(list(b['ratio']), [0., 0.])
+        self.assertTrue(all(b['latency'] != b['latency']))
+        self.assertEqual(list(b['rejects']), [2, 3])
+        self.assertFalse(b['anomaly'].any())
+
+        self.assertEqual(len(result['c']['times']), 0)
+
+    def test_window(self):
+        # window sums over 600 seconds drop as the buckets leave the
+        # window, they are not counter resets
+        history = {'a': [(0., 6000, 60, -1, 0, 600.),
+                         (60., 5400, 54, -1, 0, 600.),
+                         (120., 4800, 48, -1, 0, 600.)]}
+        a = trends.analyze(history)['a']
+        self.assertAlmostEqual(a['succ_rate'][0], 9.)
+        self.assertAlmostEqual(a['succ_rate'][1], 8.)
+        self.assertAlmostEqual(a['ratio'][1], 48 / 4848.)
@@ -1,5 +1,11 @@
+import socket
+import time
 import unittest
-from linkoauth.util import build_url
+from linkoauth.util import build_url, setup_config, config_flag
+from linkoauth.util import get_config_index, deadline, time_left
+from linkoauth.oauth import get_oauth_config
+from linkoauth.protocap import HttpRequestor
+from linkoauth.errors import DeadlineExceededError
 
 
 class TestUtil(unittest.TestCase):
@@ -15,3 +21,68 @@ class TestUtil(unittest.TestCase):
         expect = \
                 'https://graph.facebook.com/me?access_token=xxxx&fields=id%2Cf'
         self.assertTrue(res.startswith(expect))
+
+    def test_config_index(self):
+        conf = {'oauth.twitter.com.consumer_key': 'key',
+                'oauth.twitter.com.consumer_secret': 'secret',
+                'oauth.twitter.com.version': '1',
+                'oauth.yahoo.com.verified': 'true',
+                'protocol_capture_success': 'false',
+                'debug': 'on'}
+        setup_config(conf)
+        index = get_config_index()
+        self.assertTrue(get_config_index() is index)
+        self.assertEqual(index.section('oauth.yahoo.com'),
+                         {'verified': 'true'})
+        self.assertFalse(config_flag('protocol_capture_success'))
+        self.assertTrue(config_flag('debug'))
+        self.assertFalse(config_flag('not_there'))
+
+        twitter = get_oauth_config('twitter.com')
+        self.assertTrue(get_oauth_config('twitter.com') is twitter)
+        self.assertEqual(twitter.get('consumer_key'), 'key')
+        self.assertEqual(twitter.version, 1)
+        self.assertEqual(twitter.consumer.key, 'key')
+        self.assertTrue(get_oauth_config('yahoo.com').verified)
+        self.assertEqual(get_oauth_config('unknown.com'), {})
+        self.assertRaises(TypeError, twitter.__setitem__, 'scope', 'x')
+
+        # pushing a configuration invalidates the index
+        conf = dict(conf)
+        conf['oauth.twitter.com.consumer_key'] = 'other'
+        setup_config(conf)
+        self.assertFalse(get_config_index() is index)
+        self.assertEqual(get_oauth_config('twitter.com').consumer.key,
+                         'other')
+
+    def test_deadline(self):
+        setup_config({})
+        self.assertEqual(time_left(), None)
+        with deadline(time.time() + 10):
+            self.assertTrue(9 < time_left() <= 10)
+            # nested deadlines can only shorten the current one
+            with deadline(time.time() + 20):
+                self.assertTrue(time_left() <= 10)
+            with deadline(time.time() + 1):
+                self.assertTrue(time_left() <= 1)
+            with deadline(None):
+                self.assertTrue(time_left() > 9)
+            self.assertTrue(time_left() > 9)
+        self.assertEqual(time_left(), None)
+
+        with deadline(time.time() - 1):
+            self.assertRaises(DeadlineExceededError, time_left)
+
+        # a server that never answers
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        url = 'http://127.0.0.1:%d/' % server.getsockname()[1]
+        try:
+            start = time.time()
+            with deadline(time.time() + .2):
+                self.assertRaises(DeadlineExceededError,
+                                  HttpRequestor().request, url)
+            self.assertTrue(time.time() - start < 1)
+        finally:
+            server.close()
@@ -0,0 +1,81 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Raindrop.
+#
+# The Initial Developer of the Original Code is
+# Mozilla Messaging, Inc..
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+import Queue
+import threading
+import unittest
+
+from linkoauth.workers import WorkerPool
+from linkoauth.errors import CancelledError, TaskTimeoutError
+
+
+class TestWorkers(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = WorkerPool(1)
+
+    def tearDown(self):
+        self.pool.stop()
+
+    def test_get(self):
+        release = threading.Event()
+
+        def _call(value):
+            release.wait()
+            return value
+
+        task = self.pool.submit(_call, (1,))
+        self.assertRaises(TaskTimeoutError, task.get, .05)
+        release.set()
+        # get waits for the end of the task
+        self.assertEqual(task.get(), 1)
+        self.assertTrue(task.done())
+
+    def test_cancel(self):
+        started = threading.Event()
+        release = threading.Event()
+        done = Queue.Queue()
+        called = []
+
+        def _block():
+            started.set()
+            release.wait()
+
+        running = self.pool.submit(_block)
+        started.wait()
+        waiting = self.pool.submit(called.append, (1,), done=done)
+        cancelled = []
+        waiting.add_done_callback(cancelled.append)
+
+        self.assertFalse(running.cancel())
+        self.assertTrue(waiting.cancel())
+        # a cancelled task is done right away
+        self.assertTrue(waiting.done())
+        self.assertTrue(waiting.wait(0))
+        self.assertEqual(cancelled, [waiting])
+        self.assertTrue(done.get(timeout=1) is waiting)
+        self.assertRaises(CancelledError, waiting.get)
+
+        release.set()
+        running.get(timeout=5)
+        self.pool.stop()
+        self.assertEqual(called, [])
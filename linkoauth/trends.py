@@ -0,0 +1,145 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Raindrop.
+#
+# The Initial Developer of the Original Code is
+# Mozilla Messaging, Inc..
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+"""
+Trend analysis of the services history recorded by ServicesStatus.
+
+analyze() takes the result of ServicesStatus.get_history and computes,
+for all the services at once:
+
+- the successes and failures per second, between two snapshots or over
+  the sliding window when the counts are window sums
+- the failure ratio and its exponentially weighted moving average
+- anomaly flags, raised when the failure ratio jumps more than
+  `tolerance` standard deviations away from its moving average
+
+This module needs NumPy.
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None   # NOQA
+
+
+def _check_numpy():
+    if numpy is None:
+        raise ImportError('the trends analysis needs NumPy')
+
+
+def _matrix(history, services, field, default=None):
+    """Builds a services x snapshots matrix, padded with NaN on the left.
+
+    `default`, NaN by default, is used for the snapshots that have no such
+    field."""
+    if default is None:
+        default = numpy.nan
+    length = max([len(history[service]) for service in services] or [0])
+    matrix = numpy.empty((len(services), length))
+    matrix.fill(numpy.nan)
+    for row, service in enumerate(services):
+        snapshots = history[service]
+        if snapshots:
+            matrix[row, length - len(snapshots):] = \
+                [snapshot[field] if field < len(snapshot) else default
+                 for snapshot in snapshots]
+    return matrix
+
+
+def _rates(counters, times, windows):
+    """Per-second rates of counters that are reset now and then, or of
+    sliding window sums when the window is known."""
+    deltas = numpy.diff(counters, axis=1)
+    # after a reset the counter holds what happened since then
+    deltas = numpy.where(deltas < 0, counters[:, 1:], deltas)
+    elapsed = numpy.diff(times, axis=1)
+    elapsed[elapsed <= 0] = numpy.nan
+    window = windows[:, 1:]
+    # a window sum drops when buckets leave the window, it is no reset
+    return numpy.where(window > 0, counters[:, 1:] / window,
+                       deltas / elapsed)
+
+
+def analyze(history, alpha=.3, tolerance=3., min_std=.05):
+    """Returns a mapping of service -> dict of arrays, one value per
+    interval between two snapshots:
+
+    - times: the end of the interval
+    - succ_rate, fail_rate: per second
+    - ratio: failures / (successes + failures), NaN with no traffic
+    - ewma: moving average of the ratio
+    - latency: p95 latency in seconds, NaN if unknown
+    - rejects: rejected requests, as counted at the end of the interval
+    - anomaly: True where the ratio is abnormal
+    """
+    _check_numpy()
+    # NaN stands for missing values, comparing them is fine
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return _analyze(history, alpha, tolerance, min_std)
+
+
+def _analyze(history, alpha, tolerance, min_std):
+    services = sorted(history)
+    times = _matrix(history, services, 0)
+    windows = _matrix(history, services, 5, 0)
+    succ = _rates(_matrix(history, services, 1), times, windows)
+    fail = _rates(_matrix(history, services, 2), times, windows)
+    latency = _matrix(history, services, 3)[:, 1:]
+    latency[latency < 0] = numpy.nan
+    rejects = _matrix(history, services, 4)[:, 1:]
+
+    total = succ + fail
+    ratio = numpy.where(total > 0, fail / total, numpy.nan)
+
+    # moving average and variance, computed for all the services at once
+    ewma = numpy.empty_like(ratio)
+    anomaly = numpy.zeros(ratio.shape, dtype=bool)
+    mean = numpy.empty(len(services))
+    mean.fill(numpy.nan)
+    var = numpy.zeros(len(services))
+    for step in range(ratio.shape[1]):
+        value = ratio[:, step]
+        known = ~numpy.isnan(value)
+        started = known & ~numpy.isnan(mean)
+        std = numpy.maximum(numpy.sqrt(var), min_std)
+        anomaly[:, step] = started & (numpy.abs(value - mean) >
+                                      tolerance * std)
+        diff = numpy.where(started, value - mean, 0)
+        mean = numpy.where(started, mean + alpha * diff,
+                           numpy.where(known, value, mean))
+        var = numpy.where(started, (1 - alpha) * (var + alpha * diff ** 2),
+                          var)
+        ewma[:, step] = mean
+
+    result = {}
+    for row, service in enumerate(services):
+        # strips the padding
+        size = max(len(history[service]) - 1, 0)
+        start = ratio.shape[1] - size
+        result[service] = {'times': times[row, start + 1:],
+                           'succ_rate': succ[row, start:],
+                           'fail_rate': fail[row, start:],
+                           'ratio': ratio[row, start:],
+                           'ewma': ewma[row, start:],
+                           'latency': latency[row, start:],
+                           'rejects': rejects[row, start:],
+                           'anomaly': anomaly[row, start:]}
+    return result
@@ -24,6 +24,9 @@ import os
 import sgmllib
 import string
 import sys
+import time
+import threading
+from contextlib import contextmanager
 from urllib import urlencode
 
 from webob.exc import status_map
@@ -32,6 +35,8 @@ from paste.registry import StackedObjectProxy
 from paste.config import DispatchingConfig
 from mako.lookup import TemplateLookup
 
+from linkoauth.errors import DeadlineExceededError
+
 
 def redirect(url, code=302):
     """Raises a redirect exception to the specified URL
@@ -113,8 +118,103 @@ def build_url(url, **params):
 config = DispatchingConfig()
 
 
+class ConfigIndex(object):
+    """Options of a configuration, indexed by prefix, and their parsed
+    values.
+
+    Built once per configuration (see get_config_index). `derived` can
+    hold anything computed from the configuration, it is dropped with the
+    index when the configuration changes.
+    """
+    def __init__(self, conf):
+        self.conf = conf
+        self.derived = {}
+        self._flags = {}
+        self._sections = {}
+        for key, value in conf.items():
+            parts = key.split('.')
+            for pos in range(1, len(parts)):
+                prefix = '.'.join(parts[:pos])
+                section = self._sections.setdefault(prefix, {})
+                section['.'.join(parts[pos:])] = value
+
+    def section(self, prefix):
+        """Returns the options starting with `prefix.`, without the
+        prefix."""
+        return self._sections.get(prefix, {})
+
+    def flag(self, name, default=False):
+        """Returns the boolean value of an option."""
+        try:
+            return self._flags[name, default]
+        except KeyError:
+            value = asbool(self.conf.get(name, default))
+            self._flags[name, default] = value
+            return value
+
+
+_config_index = None
+
+
+def get_config_index():
+    """Returns the index of the current configuration."""
+    global _config_index
+    conf = config.current_conf()
+    index = _config_index
+    if index is None or index.conf is not conf:
+        index = _config_index = ConfigIndex(conf)
+    return index
+
+
+def config_flag(name, default=False):
+    """Returns the boolean value of an option of the current
+    configuration."""
+    return get_config_index().flag(name, default)
+
+
 def setup_config(appconfig):
+    global _config_index
     config.push_process_config(appconfig)
+    # the same dict may have been changed since it was indexed
+    _config_index = None
+
+
+_deadlines = threading.local()
+
+
+@contextmanager
+def deadline(when):
+    """Runs the block with a deadline, as a time.time() value.
+
+    The HTTP and SMTP calls made by the current thread in the block use the
+    time left as their socket timeouts, and raise DeadlineExceededError
+    once it is spent. A nested deadline can only shorten the current one.
+    None keeps the current deadline.
+    """
+    previous = getattr(_deadlines, 'when', None)
+    if when is None or (previous is not None and previous < when):
+        when = previous
+    _deadlines.when = when
+    try:
+        yield when
+    finally:
+        _deadlines.when = previous
+
+
+def current_deadline():
+    return getattr(_deadlines, 'when', None)
+
+
+def time_left():
+    """Returns the seconds left before the current deadline, or None when
+    there is no deadline. Raises DeadlineExceededError if it is spent."""
+    when = getattr(_deadlines, 'when', None)
+    if when is None:
+        return None
+    left = when - time.time()
+    if left <= 0:
+        raise DeadlineExceededError('deadline exceeded by %.3fs' % -left)
+    return left
 
 
 def _cached_template(template_name, render_func, ns_options=(),
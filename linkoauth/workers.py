@@ -0,0 +1,213 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Raindrop.
+#
+# The Initial Developer of the Original Code is
+# Mozilla Messaging, Inc..
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+"""
+A bounded pool of threads to run blocking calls (HTTP, SMTP) concurrently.
+
+    pool = WorkerPool(10)
+    task = pool.submit(requester.sendmessage, (message, options, headers))
+    result, error = task.get(timeout=5)
+
+A queue can be given to submit(): the task is put in it once done, which
+lets the caller handle the results as they complete. Callbacks can also
+be chained with Task.add_done_callback.
+
+A Bulkhead caps the number of concurrent calls to a resource, so that one
+slow provider cannot take all the threads of a process.
+"""
+import sys
+import time
+import Queue
+import logging
+import threading
+
+from linkoauth.errors import CancelledError, TaskTimeoutError
+
+log = logging.getLogger(__name__)
+
+
+class Task(object):
+    """A call submitted to a WorkerPool."""
+    def __init__(self, func, args=(), kw=None, done=None):
+        self.func = func
+        self.args = args
+        self.kw = kw or {}
+        self.result = None
+        self.exc_info = None
+        self.started = self.cancelled = False
+        self._done = done
+        self._callbacks = []
+        self._finished = threading.Event()
+        self._lock = threading.Lock()
+
+    def run(self):
+        with self._lock:
+            if self.cancelled:
+                return
+            self.started = True
+        try:
+            self.result = self.func(*self.args, **self.kw)
+        except Exception:
+            self.exc_info = sys.exc_info()
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._finished.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            self._call(callback)
+        if self._done is not None:
+            self._done.put(self)
+
+    def _call(self, callback):
+        try:
+            callback(self)
+        except Exception:
+            log.exception('error in the callback of a task')
+
+    def add_done_callback(self, callback):
+        """Calls `callback(task)` once the task is done, right away if it
+        is already done. The callback runs in the worker thread."""
+        with self._lock:
+            if not self._finished.is_set():
+                self._callbacks.append(callback)
+                return
+        self._call(callback)
+
+    def cancel(self):
+        """Cancels the task if it did not start yet, get() then raises
+        CancelledError. Returns True if it was cancelled."""
+        with self._lock:
+            if self.started or self.cancelled:
+                return self.cancelled
+            self.cancelled = True
+            try:
+                raise CancelledError()
+            except CancelledError:
+                self.exc_info = sys.exc_info()
+        self._finish()
+        return True
+
+    def done(self):
+        return self._finished.is_set()
+
+    def wait(self, timeout=None):
+        """Waits for the end of the task. Returns False on timeout."""
+        self._finished.wait(timeout)
+        return self._finished.is_set()
+
+    def get(self, timeout=None):
+        """Waits for the end of the task and returns its result, or raises
+        its exception. Raises TaskTimeoutError if the task is not done
+        within `timeout` seconds."""
+        if not self.wait(timeout):
+            raise TaskTimeoutError()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+
+class WorkerPool(object):
+    """Runs the submitted tasks in `size` daemon threads, started on the
+    first submission."""
+    def __init__(self, size, name='linkoauth-worker'):
+        self.size = size
+        self.name = name
+        self._tasks = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _run(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                break
+            task.run()
+
+    def _start(self):
+        with self._lock:
+            while len(self._threads) < self.size:
+                thread = threading.Thread(target=self._run, name=self.name)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, func, args=(), kw=None, done=None):
+        """Queues a call and returns its Task. When `done` is a queue, the
+        task is put in it once finished."""
+        if len(self._threads) < self.size:
+            self._start()
+        task = Task(func, args, kw, done)
+        self._tasks.put(task)
+        return task
+
+    def stop(self):
+        """Stops the threads once the queued tasks are run."""
+        with self._lock:
+            threads, self._threads = self._threads, []
+            for thread in threads:
+                self._tasks.put(None)
+        for thread in threads:
+            thread.join()
+
+
+class Bulkhead(object):
+    """Limits the number of concurrent calls to `size`.
+
+    The callers over the limit wait for a free slot, up to the timeout
+    given to acquire().
+    """
+    def __init__(self, size):
+        self.size = size
+        self.active = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """Takes a slot. Returns False if none freed up within `timeout`
+        seconds. A timeout of 0 fails fast, None waits forever."""
+        with self._cond:
+            if self.active < self.size:
+                self.active += 1
+                return True
+            if timeout is not None:
+                deadline = time.time() + timeout
+            self.waiting += 1
+            try:
+                while self.active >= self.size:
+                    if timeout is None:
+                        self._cond.wait()
+                        continue
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.active += 1
+            return True
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
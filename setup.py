@@ -47,6 +47,7 @@ setup(
         "mock",
         "pylibmc",
         "Services"],
+    extras_require={'trends': ['numpy']},
     packages=find_packages(exclude=['ez_setup']),
     include_package_data=True,
     test_suite='nose.collector',